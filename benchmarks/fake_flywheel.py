@@ -0,0 +1,515 @@
+"""In-process stand-in for the parts of the flywheel SDK used by run.py.
+
+`install()` registers a fake `flywheel` module, so that run.py can be imported
+without the SDK, and `FakeClient` implements the client surface used by the
+gear (projects, rules, gears, users, permissions and files) in memory, with
+call counting and injected latency/bandwidth.
+
+File contents are synthetic: a file of any size is generated on the fly from a
+seed, so multi-GB fixed inputs cost neither memory nor disk. Uploaded files are
+consumed and only their size and hash are kept.
+"""
+
+import copy
+import hashlib
+import io
+import itertools
+import os
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from urllib.parse import parse_qsl, unquote
+
+import requests
+import requests.adapters
+
+BLOCK = hashlib.sha512(b'grp-15').digest() * 16384  # 1 MiB of pseudo-random bytes
+
+
+class ApiException(Exception):
+    def __init__(self, status=None, reason=None, detail=None, headers=None):
+        super(ApiException, self).__init__(f'({status}) {reason}')
+        self.status = status
+        self.reason = reason
+        self.detail = detail
+        self.headers = headers
+
+
+class Model(object):
+    """Minimal SDK model: attribute and item access, and to_dict."""
+
+    fields = ()
+
+    def __init__(self, **kwargs):
+        for field in self.fields:
+            setattr(self, field, kwargs.get(field))
+
+    def to_dict(self):
+        def convert(value):
+            if hasattr(value, 'to_dict'):
+                return value.to_dict()
+            if isinstance(value, list):
+                return [convert(x) for x in value]
+            if isinstance(value, dict):
+                return {k: convert(v) for k, v in value.items()}
+            return value
+        return {field: convert(getattr(self, field)) for field in self.fields}
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+
+class RolesRoleAssignment(Model):
+    fields = ('id', 'role_ids')
+
+    def __init__(self, id=None, role_ids=None):
+        super(RolesRoleAssignment, self).__init__(id=id, role_ids=role_ids)
+
+
+class Rule(Model):
+    fields = ('project_id', 'gear_id', 'name', 'config', 'fixed_inputs', 'auto_update',
+              'any', 'all', '_not', 'disabled', 'compute_provider_id', 'id')
+
+
+class GearManifest(Model):
+    fields = ('name', 'version', 'label')
+
+
+class GearDoc(Model):
+    fields = ('id', 'gear', 'category')
+
+
+class FileEntry(Model):
+    fields = ('name', 'size', 'hash', 'mimetype', 'modified')
+
+
+class User(Model):
+    fields = ('id', 'firstname', 'lastname')
+
+
+class Group(Model):
+    fields = ('id', 'label', 'permissions_template')
+
+
+class Analysis(Model):
+    fields = ('id', 'parent')
+
+
+class Project(Model):
+    """Unsaved project (the fake client returns FakeContainer for stored projects)."""
+    fields = ('id', 'group', 'label', 'permissions', 'files')
+
+
+class FileSpec(object):
+    def __init__(self, name, contents=None, content_type=None):
+        self.name = name
+        self.contents = contents
+        self.content_type = content_type
+
+
+class SyntheticBlob(object):
+    """File content of <size> bytes, generated from <seed> on demand."""
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed % len(BLOCK)
+        self._hash = None
+
+    def iter_chunks(self, start=0, end=None, chunk_size=1024 * 1024):
+        end = self.size if end is None else min(end, self.size)
+        position = start
+        while position < end:
+            offset = (position + self.seed) % len(BLOCK)
+            length = min(chunk_size, end - position, len(BLOCK) - offset)
+            yield BLOCK[offset:offset + length]
+            position += length
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            digest = hashlib.sha384()
+            for chunk in self.iter_chunks():
+                digest.update(chunk)
+            self._hash = 'v0-sha384-' + digest.hexdigest()
+        return self._hash
+
+
+class StoredBlob(object):
+    """Size and hash of uploaded content (the content itself is discarded)."""
+
+    def __init__(self, size, hash):
+        self.size = size
+        self.hash = hash
+
+    def iter_chunks(self, start=0, end=None, chunk_size=None):
+        raise ApiException(501, 'Not Implemented', 'Uploaded content is not kept by the fake client')
+
+
+class BlobReader(io.RawIOBase):
+    """Readable file object over a range of a blob."""
+
+    def __init__(self, blob, start=0, end=None, client=None):
+        self._chunks = blob.iter_chunks(start, end)
+        self._buffer = b''
+        self._client = client
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+            if self._client:
+                self._client.transfer(len(self._buffer))
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class FakeContainer(object):
+    container_type = 'project'
+
+    def __init__(self, client, id, group=None, label=None):
+        self._client = client
+        self.id = id
+        self.group = group
+        self.label = label
+        self.permissions = list()
+        self._files = dict()  # name -> (FileEntry, blob)
+
+    @property
+    def files(self):
+        return [copy.copy(entry) for entry, _ in self._files.values()]
+
+    def blob(self, name):
+        if name not in self._files:
+            raise ApiException(404, 'Not Found', f'File {name} not found')
+        return self._files[name][1]
+
+    def add_file(self, name, blob):
+        entry = FileEntry(name=name, size=blob.size, hash=blob.hash,
+                          mimetype='application/octet-stream', modified=time.time())
+        self._files[name] = (entry, blob)
+        return entry
+
+    def reload(self):
+        self._client.call('get_project')
+        return self
+
+    def download_file(self, file_name, dest_file):
+        self._client.call('download_file')
+        with open(dest_file, 'wb') as fp:
+            for chunk in self.blob(file_name).iter_chunks():
+                self._client.transfer(len(chunk))
+                fp.write(chunk)
+
+    def get_file_download_url(self, file_name):
+        self._client.call('get_download_url')
+        self.blob(file_name)
+        ticket = self._client.new_id()
+        self._client.tickets[ticket] = time.time()
+        return f'fake://{self.id}/{file_name}?ticket={ticket}'
+
+    def upload_file(self, file):
+        self._client.call('upload_file')
+        if isinstance(file, FileSpec):
+            name = os.path.basename(file.name)
+            stream = file.contents
+            if stream is None:
+                stream = open(file.name, 'rb')
+            elif isinstance(stream, (bytes, str)):
+                stream = io.BytesIO(stream if isinstance(stream, bytes) else stream.encode())
+        else:
+            name = os.path.basename(file)
+            stream = open(file, 'rb')
+        digest = hashlib.sha384()
+        size = 0
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            self._client.transfer(len(chunk))
+            digest.update(chunk)
+            size += len(chunk)
+        self.add_file(name, StoredBlob(size, 'v0-sha384-' + digest.hexdigest()))
+
+    def add_permission(self, permission):
+        self._client.call('add_permission')
+        if any(p.id == permission.id for p in self.permissions):
+            raise ApiException(409, 'Conflict', 'Permission exists')
+        self.permissions.append(RolesRoleAssignment(permission.id, permission.role_ids))
+
+
+class FakeClient(object):
+    """In-memory flywheel.Client.
+
+    Args:
+        latency (float): Seconds added to every API call. Defaults to 0.
+        bandwidth (float): Transfer rate of file content in bytes/s, None for
+            unlimited. Defaults to None.
+        host (str): Instance host name. Defaults to 'fake.flywheel.io'.
+        id_offset (int): First object id, to tell instances apart. Defaults to 1.
+        ticket_ttl (float): Lifetime of download urls in seconds, None for
+            unlimited. Defaults to None.
+        range_requests (bool): Honour the Range header of downloads. When False,
+            the whole file is sent with a 200, like servers which ignore it.
+            Defaults to True.
+
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, host='fake.flywheel.io', id_offset=1, ticket_ttl=None,
+                 range_requests=True):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ticket_ttl = ticket_ttl
+        self.range_requests = range_requests
+        self.bytes_transferred = 0  # File content downloaded and uploaded
+        self.tickets = dict()  # ticket -> issue time
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(id_offset)
+        self.groups = dict()
+        self.projects = dict()
+        self.rules = dict()
+        self.gears = dict()
+        self.invalid_gears = set()  # Ids of the gears flagged invalid
+        self.users = dict()
+        self.analyses = dict()
+        self.api_client = types.SimpleNamespace(
+            rest_client=types.SimpleNamespace(session=requests.Session()),
+            configuration=types.SimpleNamespace(host=f'https://{host}/api'))
+
+    # Accounting
+    def call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, nbytes):
+        with self._lock:
+            self.bytes_transferred += nbytes
+        if self.bandwidth:
+            time.sleep(nbytes / float(self.bandwidth))
+
+    def new_id(self):
+        return '%024x' % next(self._ids)
+
+    # Seeding
+    def seed_group(self, group_id, permissions_template=()):
+        self.groups[group_id] = Group(id=group_id, label=group_id, permissions_template=list(permissions_template))
+        return self.groups[group_id]
+
+    def seed_project(self, group_id, label):
+        project = FakeContainer(self, self.new_id(), group_id, label)
+        self.projects[project.id] = project
+        self.rules[project.id] = list()
+        return project
+
+    def seed_gear(self, name, version, invalid=False):
+        gear_doc = GearDoc(id=self.new_id(), gear=GearManifest(name=name, version=version, label=name))
+        self.gears[gear_doc.id] = gear_doc
+        if invalid:
+            self.invalid_gears.add(gear_doc.id)
+        return gear_doc
+
+    def seed_user(self, user_id):
+        self.users[user_id] = User(id=user_id)
+        return self.users[user_id]
+
+    def seed_rule(self, project, **fields):
+        rule = Rule(project_id=project.id, id=self.new_id(), **fields)
+        self.rules[project.id].append(rule)
+        return rule
+
+    def seed_analysis(self, project):
+        analysis = Analysis(id=self.new_id(), parent={'type': 'project', 'id': project.id})
+        self.analyses[analysis.id] = analysis
+        return analysis
+
+    # SDK surface
+    def get(self, id, **kwargs):
+        self.call('get')
+        if id not in self.projects:
+            raise ApiException(404, 'Not Found', f'Container {id} not found')
+        return self.projects[id]
+
+    def get_project(self, project_id, **kwargs):
+        self.call('get_project')
+        if project_id not in self.projects:
+            raise ApiException(404, 'Not Found', f'Project {project_id} not found')
+        return self.projects[project_id]
+
+    def get_analysis(self, analysis_id, **kwargs):
+        self.call('get_analysis')
+        return self.analyses[analysis_id]
+
+    def get_group(self, group_id, **kwargs):
+        self.call('get_group')
+        if group_id not in self.groups:
+            raise ApiException(404, 'Not Found', f'Group {group_id} not found')
+        return self.groups[group_id]
+
+    def get_group_projects(self, group_id, **kwargs):
+        self.call('get_group_projects')
+        return [p for p in self.projects.values() if p.group == group_id]
+
+    def add_project(self, body, **kwargs):
+        self.call('add_project')
+        if body['group'] not in self.groups:
+            raise ApiException(404, 'Not Found', 'Group not found')
+        return self.seed_project(body['group'], body['label']).id
+
+    def lookup(self, path, **kwargs):
+        self.call('lookup')
+        parts = path.split('/')
+        if parts[0] == 'gears' and len(parts) == 3:
+            for gear_doc in self.gears.values():
+                if (gear_doc.gear.name, gear_doc.gear.version) == (parts[1], parts[2]):
+                    return gear_doc
+        elif len(parts) == 2:
+            for project in self.projects.values():
+                if (project.group, project.label) == (parts[0], parts[1]):
+                    return project
+        raise ApiException(404, 'Not Found', f'{path} not found')
+
+    def get_gear(self, gear_id, **kwargs):
+        self.call('get_gear')
+        if gear_id not in self.gears:
+            raise ApiException(404, 'Not Found', f'Gear {gear_id} not found')
+        return self.gears[gear_id]
+
+    def get_all_gears(self, include_invalid=False, **kwargs):
+        # Like the platform, gears flagged invalid are only listed on request
+        self.call('get_all_gears')
+        return [g for g in self.gears.values() if include_invalid or g.id not in self.invalid_gears]
+
+    def get_user(self, user_id, **kwargs):
+        self.call('get_user')
+        if user_id not in self.users:
+            raise ApiException(404, 'Not Found', f'User {user_id} not found')
+        return self.users[user_id]
+
+    def get_all_users(self, **kwargs):
+        self.call('get_all_users')
+        return list(self.users.values())
+
+    def get_project_rules(self, project_id, **kwargs):
+        self.call('get_project_rules')
+        return copy.deepcopy(self.rules[project_id])
+
+    def _to_rule(self, project_id, body):
+        fields = copy.deepcopy(body.to_dict() if hasattr(body, 'to_dict') else dict(body))
+        fields['project_id'] = project_id
+        return Rule(**fields)
+
+    def add_project_rule(self, project_id, body, **kwargs):
+        self.call('add_project_rule')
+        rule = self._to_rule(project_id, body)
+        if rule.gear_id not in self.gears:
+            raise ApiException(422, 'Unprocessable Entity', f'Gear {rule.gear_id} not found')
+        rule.id = self.new_id()
+        self.rules[project_id].append(rule)
+        return rule.id
+
+    def modify_project_rule(self, project_id, rule_id, body, **kwargs):
+        self.call('modify_project_rule')
+        for i, rule in enumerate(self.rules[project_id]):
+            if rule.id == rule_id:
+                self.rules[project_id][i] = self._to_rule(project_id, body)
+                self.rules[project_id][i].id = rule_id
+                return
+        raise ApiException(404, 'Not Found', f'Rule {rule_id} not found')
+
+    def remove_project_rule(self, project_id, rule_id, **kwargs):
+        self.call('remove_project_rule')
+        rules = [r for r in self.rules[project_id] if r.id != rule_id]
+        if len(rules) == len(self.rules[project_id]):
+            raise ApiException(404, 'Not Found', f'Rule {rule_id} not found')
+        self.rules[project_id] = rules
+
+
+class FakeTransportAdapter(requests.adapters.BaseAdapter):
+    """Serve `fake://<container_id>/<file_name>` download urls from a
+    FakeClient. Like the platform, the Range header is only honoured on
+    urls with view=true."""
+
+    def __init__(self, client):
+        super(FakeTransportAdapter, self).__init__()
+        self.client = client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        path, _, query = request.url[len('fake://'):].partition('?')
+        container_id, file_name = path.split('/', 1)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        params = dict(parse_qsl(query))
+        issued = self.client.tickets.get(params.get('ticket'))
+        if issued is None or (self.client.ticket_ttl and time.time() - issued > self.client.ticket_ttl):
+            response.status_code = 400
+            response.raw = io.BytesIO(b'Invalid or expired ticket')
+            return response
+        try:
+            blob = self.client.projects[container_id].blob(unquote(file_name))
+        except (KeyError, ApiException):
+            response.status_code = 404
+            response.raw = io.BytesIO(b'')
+            return response
+        start, end = 0, blob.size
+        response.status_code = 200
+        if request.headers.get('Range') and self.client.range_requests and params.get('view') == 'true':
+            first, _, last = request.headers['Range'].split('=', 1)[1].partition('-')
+            start, end = int(first), (int(last) + 1 if last else blob.size)
+            response.status_code = 206
+        response.headers['Content-Length'] = str(max(0, min(end, blob.size) - start))
+        response.raw = io.BufferedReader(BlobReader(blob, start, end, self.client), 1024 * 1024)
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeGearContext(object):
+    """Stand-in for flywheel.gear_context.GearContext."""
+
+    def __init__(self, client, output_dir, config=None, inputs=None, destination=None):
+        self.client = client
+        self.output_dir = output_dir
+        self.config = config or dict()
+        self.inputs = inputs or dict()
+        self.destination = destination or dict()
+
+    def get_input_path(self, name):
+        return self.inputs.get(name)
+
+
+def install():
+    """Register the fake `flywheel` module in sys.modules (before importing run.py)."""
+    module = types.ModuleType('flywheel')
+    module.ApiException = ApiException
+    module.RolesRoleAssignment = RolesRoleAssignment
+    module.FileSpec = FileSpec
+    module.Project = Project
+    module.Client = FakeClient
+    module.models = types.ModuleType('flywheel.models')
+    module.models.rule = types.SimpleNamespace(Rule=Rule)
+    module.models.roles_role_assignment = types.SimpleNamespace(RolesRoleAssignment=RolesRoleAssignment)
+    module.gear_context = types.SimpleNamespace(GearContext=FakeGearContext)
+    sys.modules['flywheel'] = module
+    sys.modules['flywheel.models'] = module.models
+    return module
+
+
+def mount(session, client):
+    """Serve the fake download urls of <client> through <session>."""
+    session.mount('fake://', FakeTransportAdapter(client))
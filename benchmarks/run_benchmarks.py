@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""Offline benchmarks of the GRP-15 export, import and clone workflows.
+
+Every case runs in its own process against an in-memory fake Flywheel instance
+(see fake_flywheel.py), and reports wall time, API calls, peak RSS, peak
+scratch disk usage and the size of the gear outputs.
+
+Examples:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scenarios clone --rules 10,100,1000 \\
+        --users 1000,50000 --fixed-input-size 0,1G,20G --latency 0.02
+    python benchmarks/run_benchmarks.py --config stream_fixed_inputs=false --output results.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse a size such as '512M' or '20G' into bytes."""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_list(text, convert=int):
+    return [convert(x) for x in text.split(',') if x.strip()]
+
+
+def get_dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskSampler(threading.Thread):
+    """Track the peak size of a directory while a case runs."""
+
+    def __init__(self, path, interval=0.05):
+        super(DiskSampler, self).__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, get_dir_size(self.path))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, get_dir_size(self.path))
+
+
+def seed_instance(fake, case, id_offset=1):
+    """Create a fake instance with a source project holding <case['rules']> gear
+    rules, which reference <case['fixed_inputs']> files of <case['fixed_input_size']>
+    bytes in total."""
+
+    fw = fake.FakeClient(latency=case['latency'], bandwidth=case['bandwidth'], id_offset=id_offset,
+                         range_requests=case.get('range_requests', True))
+    fw.seed_group('bench')
+    for i in range(case['users']):
+        fw.seed_user(f'user{i}@bench.test')
+    gears = [fw.seed_gear(f'bench-gear-{i}', '1.0.{}'.format(i)) for i in range(max(1, case['rules'] // 10))]
+
+    source = fw.seed_project('bench', 'source')
+    source.permissions = [fake.RolesRoleAssignment(f'user{i}@bench.test', ['read-write'])
+                          for i in range(min(case['permissions'], case['users']))]
+    nfiles = case['fixed_inputs'] if case['fixed_input_size'] else 0
+    for i in range(nfiles):
+        source.add_file(f'atlas-{i}.nii.gz', fake.SyntheticBlob(case['fixed_input_size'] // nfiles, seed=i * 7919))
+
+    for i in range(case['rules']):
+        fixed_inputs = list()
+        if nfiles and i % 2 == 0:
+            fixed_inputs.append({'type': 'project', 'id': source.id, 'name': f'atlas-{i // 2 % nfiles}.nii.gz',
+                                 'input': 'atlas', 'base': 'file', 'found': None})
+        fw.seed_rule(source, gear_id=gears[i % len(gears)].id, name=f'rule-{i}', config={'threshold': i},
+                     fixed_inputs=fixed_inputs, auto_update=False, any=list(), _not=list(),
+                     all=[{'type': 'file.type', 'value': 'dicom', 'regex': None}], disabled=False)
+    return fw, source
+
+
+def run_case(case):
+    """Run one benchmark case (in the current process) and return its results."""
+
+    sys.path.insert(0, HERE)
+    sys.path.insert(0, os.path.dirname(HERE))
+    import fake_flywheel as fake
+    fake.install()
+    import run
+    import logging
+    logging.basicConfig(level=getattr(logging, case['log_level']))
+    run.log.setLevel(getattr(logging, case['log_level']))
+
+    workdir = tempfile.mkdtemp(prefix='grp15-bench-')
+    scratch = os.path.join(workdir, 'tmp')
+    output = os.path.join(workdir, 'output')
+    os.mkdir(scratch)
+    os.mkdir(output)
+    tempfile.tempdir = scratch
+
+    config = {'permissions': True, 'default_group_permissions': False, 'gear_rules': True,
+              'apply_to_existing_project': True, 'existing_rules': 'REPLACE', 'gear-log-level': case['log_level']}
+    config.update(case['config'])
+
+    fw, source = seed_instance(fake, case)
+    fake.mount(run.get_http_session(), fw)
+    gear_context = fake.FakeGearContext(fw, output, config, destination={'type': 'analysis', 'id': fw.seed_analysis(source).id})
+
+    target_fw = fw
+    if case['scenario'] == 'import':
+        # Export on the source instance (not measured), import on another instance
+        template = run.generate_project_template(gear_context, source)
+        archive = run.download_fixed_inputs(gear_context, template, source.id)
+        target_fw, _ = seed_instance(fake, dict(case, rules=0, fixed_input_size=0), id_offset=10 ** 6)
+        for gear_doc in fw.gears.values():
+            target_fw.seed_gear(gear_doc.gear.name, gear_doc.gear.version)
+        gear_context = fake.FakeGearContext(target_fw, output, config)
+        run.GEAR_CACHE = run.GearCache()
+        run.METRICS.reset()
+
+    sampler = DiskSampler(scratch)
+    sampler.start()
+    fw.calls.clear()
+    target_fw.calls.clear()
+    start = time.time()
+    status = 0
+
+    if case['scenario'] in ('export', 'clone'):
+        template = run.generate_project_template(gear_context, source)
+        archive = run.download_fixed_inputs(gear_context, template, source.id)
+    if case['scenario'] in ('import', 'clone'):
+        project = run.get_or_create_project(target_fw, 'bench', 'clone')
+        status = run.apply_template_to_project(gear_context, project, template, archive)
+
+    wall_time = time.time() - start
+    sampler.stop()
+    calls = fw.calls + target_fw.calls if target_fw is not fw else fw.calls
+    result = dict(case, wall_time=round(wall_time, 3), exit_status=status,
+                  api_calls=sum(calls.values()), api_calls_by_endpoint=dict(calls),
+                  peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+                  peak_scratch_mb=round(sampler.peak / 1024.0 ** 2, 1),
+                  output_mb=round(get_dir_size(output) / 1024.0 ** 2, 1))
+    shutil.rmtree(workdir)
+    return result
+
+
+def format_table(results):
+    columns = ['scenario', 'rules', 'users', 'fixed_input_size', 'wall_time', 'api_calls',
+               'peak_rss_mb', 'peak_scratch_mb', 'output_mb', 'exit_status']
+    rows = [columns] + [[str(r[c]) for c in columns] for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(value.rjust(width) for value, width in zip(row, widths)) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='export,import,clone', help='Comma separated: export, import, clone')
+    parser.add_argument('--rules', default='10,100,1000', help='Comma separated numbers of gear rules')
+    parser.add_argument('--users', default='1000', help='Comma separated numbers of users on the instance')
+    parser.add_argument('--permissions', type=int, default=50, help='Number of permissions on the source project')
+    parser.add_argument('--fixed-input-size', default='0,64M', help='Comma separated total fixed input sizes (e.g. 0,1G,20G)')
+    parser.add_argument('--fixed-inputs', type=int, default=4, help='Number of fixed input files')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call')
+    parser.add_argument('--bandwidth', type=parse_size, default=None, help='File transfer rate per second (e.g. 100M)')
+    parser.add_argument('--no-range-requests', dest='range_requests', action='store_false',
+                        help='Serve whole files to ranged downloads, like servers ignoring the Range header')
+    parser.add_argument('--config', action='append', default=list(), metavar='KEY=VALUE',
+                        help='Gear config override (value parsed as JSON), may be repeated')
+    parser.add_argument('--log-level', default='WARNING', help='Log level of the gear')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    config = dict()
+    for item in args.config:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+
+    results = list()
+    for scenario, rules, users, size in itertools.product(args.scenarios.split(','), parse_list(args.rules),
+                                                          parse_list(args.users), parse_list(args.fixed_input_size, parse_size)):
+        case = {'scenario': scenario, 'rules': rules, 'users': users, 'permissions': args.permissions,
+                'fixed_input_size': size, 'fixed_inputs': args.fixed_inputs, 'latency': args.latency,
+                'bandwidth': args.bandwidth, 'range_requests': args.range_requests, 'config': config, 'log_level': args.log_level}
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            print(f'Case failed: {case}', file=sys.stderr)
+            results.append(dict(case, wall_time=None, api_calls=None, peak_rss_mb=None, peak_scratch_mb=None,
+                                output_mb=None, exit_status=proc.returncode))
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        print(format_table(results[-1:]).splitlines()[-1], file=sys.stderr)
+
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w') as of:
+            json.dump(results, of, indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,40 +2,1904 @@
 
 
 import os
+import copy
 import json
-import glob2
+import contextlib
+import contextvars
+import cProfile
+import fnmatch
+import functools
+import inspect
 import tempfile
 import shutil
 import flywheel
+import requests
+import requests.adapters
 import zipfile
+import zlib
+import bz2
+import hashlib
 import logging
-from pprint import pprint as pp
+import struct
+import sys
+import random
+import re
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed by the zstd archive codec
+    zstandard = None
 
 log = logging.getLogger("GRP-15")
 
+GEAR_CACHE_FILENAME = 'project-settings_gear-cache.json'
+GEAR_CACHE_VERSION = 1
+JOURNAL_FILENAME = 'project-settings_journal.jsonl'
+COMPILED_TEMPLATE_FILENAME = 'project-settings_compiled-templates.json'
+COMPILED_TEMPLATE_VERSION = 1
+DEFAULT_MAX_WORKERS = 4
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files with these extensions are already compressed, and are STORED in archives
+# rather than wasting CPU on compression for (almost) no size gain.
+COMPRESSED_EXTENSIONS = ('.gz', '.tgz', '.zip', '.bz2', '.xz', '.lzma', '.zst', '.7z', '.mgz',
+                         '.npz', '.pt', '.pth', '.ckpt', '.jpg', '.jpeg', '.png', '.mp4')
+
+# Archive member listing the size and content hash of each fixed input
+ARCHIVE_MANIFEST_NAME = 'project-settings_manifest.json'
+ARCHIVE_MANIFEST_VERSION = 2
+# Python versions whose zipfile internals `write_compressed_member` is known to
+# work with (see tests/test_archive.py). Others write members through the
+# public zipfile API, which compresses them again.
+RAW_MEMBER_PYTHON_VERSIONS = ((3, 8), (3, 13))
+RAW_MEMBERS = RAW_MEMBER_PYTHON_VERSIONS[0] <= sys.version_info[:2] <= RAW_MEMBER_PYTHON_VERSIONS[1]
+BUNDLE_NAME = 'project-settings_bundle'
+BUNDLE_INDEX_NAME = 'index.json'
+BUNDLE_VERSION = 1
+TEMPLATE_STREAM_VERSION = 1
+# Record type of the items of each template field, in template streams
+TEMPLATE_RECORDS = {'permissions': 'permission', 'rules': 'rule'}
+
+# Values of config.profiling, and number of entries of the profile summaries
+PROFILE_MODES = ('OFF', 'CPU', 'MEMORY', 'ALL')
+PROFILE_TOP = 15
+PROFILE_NAME = 'project-settings_profile'
+# Modules in which idle threads wait, or memory profiling runs (left out of the CPU hotspots)
+PROFILE_IGNORED_MODULES = ('threading.py', 'queue.py', 'thread.py', 'tracemalloc.py')
+
+_HTTP_SESSION = None
+
+
+CURRENT_PHASE = contextvars.ContextVar('phase', default=None)
+
+
+class RunProfiler(object):
+    """CPU and memory profiling of a run (config.profiling), to diagnose slow or
+    out of memory runs from the outputs of the run itself.
+
+    CPU profiling runs cProfile on the main thread, and samples the stacks of
+    every thread every <interval> seconds, as the transfers, hashing and
+    compression done by worker threads are invisible to cProfile.
+
+    Memory profiling traces allocations with tracemalloc. For each phase (see
+    RunMetrics) it records the peak traced memory, and the source lines whose
+    allocations grew the most between the start and the end of the phase.
+    Phases of projects processed concurrently overlap, so their figures include
+    each other's allocations. A snapshot of the allocations is taken whenever
+    the traced memory reaches a new high, and written out at once, so that it
+    is left behind by a run killed for running out of memory.
 
-def create_archive(content_dir, arcname, zipfilepath=None):
+    Args:
+        interval (float): Seconds between stack samples. Defaults to 0.01.
+        nframes (int): Frames stored with each traced allocation. Defaults to 5.
+
+    """
+
+    def __init__(self, interval=0.01, nframes=5):
+        self.interval = interval
+        self.nframes = nframes
+        self.cpu = False
+        self.memory = False
+        self.output_dir = None
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        self._done = threading.Event()
+        self._sampler = None
+        self._profile = None
+        self.samples = Counter()  # Collapsed stack (root first) -> number of samples
+        self.phases = OrderedDict()
+        self._active = Counter()  # Phases in progress
+        self._snapshot_size = 0
+
+    def _get_name(self, suffix):
+        return os.path.join(self.output_dir, PROFILE_NAME + suffix)
+
+    def start(self, mode, output_dir):
+        """Start profiling.
+
+        Args:
+            mode (str): One of PROFILE_MODES: CPU and/or MEMORY profiling, or OFF.
+            output_dir (str): Directory to which the results are saved.
+
+        """
+
+        mode = (mode or 'OFF').upper()
+        if mode not in PROFILE_MODES:
+            log.warning(f'Unknown profiling mode {mode}, profiling is disabled.')
+            mode = 'OFF'
+        self.cpu = mode in ('CPU', 'ALL')
+        self.memory = mode in ('MEMORY', 'ALL')
+        if not (self.cpu or self.memory):
+            return
+        self.output_dir = output_dir
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+        if self.cpu:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._done.clear()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._sampler.start()
+        log.info(f'Profiling enabled ({mode}), results are saved to {PROFILE_NAME}* files.')
+
+    def _sample(self):
+        sampler_id = threading.get_ident()
+        while not self._done.wait(self.interval):
+            if self.cpu:
+                stacks = list()
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == sampler_id:
+                        continue
+                    stack = list()
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                        frame = frame.f_back
+                    stacks.append(';'.join(reversed(stack)))
+                with self._lock:
+                    self.samples.update(stacks)
+            if self.memory:
+                self._track_memory()
+
+    def _track_memory(self):
+        current = tracemalloc.get_traced_memory()[0]
+        with self._lock:
+            for name in self._active:
+                self.phases[name]['peak_memory'] = max(self.phases[name]['peak_memory'], current)
+            # Snapshots are costly, only take one when the high grows by 10%
+            if current <= self._snapshot_size * 1.1:
+                return
+            self._snapshot_size = current
+        # One dump at a time, each replacing the previous one whole, so that a run
+        # killed mid-dump still leaves a complete snapshot behind
+        with self._dump_lock:
+            filename = self._get_name('-peak.tracemalloc')
+            try:
+                tracemalloc.take_snapshot().dump(filename + '.tmp')
+                os.replace(filename + '.tmp', filename)
+            except OSError as err:
+                log.warning(f'Could not save allocations snapshot: {err}')
+                return
+        log.debug(f'Saved allocations snapshot at {format_size(current)} traced memory')
+
+    @staticmethod
+    def _describe(traceback):
+        # Line of the allocation, and the innermost line of this gear leading to it
+        line = str(traceback[-1])
+        callers = [str(frame) for frame in traceback if frame.filename == __file__]
+        if callers and callers[-1] != line:
+            line += f' (from {callers[-1]})'
+        return line
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager recording the memory allocated by the enclosed work as phase <name>."""
+        if not self.memory:
+            yield
+            return
+        before = tracemalloc.take_snapshot()
+        with self._lock:
+            self._active[name] += 1
+            self.phases.setdefault(name, {'count': 0, 'peak_memory': 0, 'allocations': Counter()})
+        try:
+            yield
+        finally:
+            self._track_memory()
+            growth = tracemalloc.take_snapshot().compare_to(before, 'traceback')
+            with self._lock:
+                self._active[name] -= 1
+                if not self._active[name]:
+                    del self._active[name]
+                phase = self.phases[name]
+                phase['count'] += 1
+                for stat in growth[:PROFILE_TOP]:
+                    if stat.size_diff > 0:
+                        phase['allocations'][self._describe(stat.traceback)] += stat.size_diff
+
+    def get_hotspots(self, top=PROFILE_TOP):
+        """Return the functions found most often at the top of the stack samples
+        of busy threads.
+
+        Returns:
+            tuple: Number of samples, and list of (function, samples in which it
+                was running, samples in which it was on the stack) tuples.
+
+        """
+
+        own, total = Counter(), Counter()
+        with self._lock:
+            samples = self.samples.copy()
+        nsamples = 0
+        for stack, count in samples.items():
+            frames = stack.split(';')
+            if frames[-1].partition(' (')[2].startswith(PROFILE_IGNORED_MODULES):
+                continue
+            nsamples += count
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return nsamples, [(frame, count, total[frame]) for frame, count in own.most_common(top)]
+
+    def stop(self):
+        """Stop profiling, save the results to the output directory and log a
+        summary of the hotspots. Errors saving the results are logged, not raised.
+
+        Returns:
+            list: Full paths to the files saved.
+
+        """
+
+        if not (self.cpu or self.memory):
+            return list()
+        self._done.set()
+        self._sampler.join()
+        if self.cpu:
+            self._profile.disable()
+        files = list()
+        try:
+            if self.cpu:
+                files.append(self._get_name('-main.pstats'))
+                self._profile.dump_stats(files[-1])
+                files.append(self._get_name('-samples.txt'))
+                with open(files[-1], 'w') as sf:
+                    for stack, count in self.samples.most_common():
+                        sf.write(f'{stack} {count}\n')
+
+                nsamples, hotspots = self.get_hotspots()
+                lines = [f'{100.0 * count / nsamples:5.1f}% {100.0 * total / nsamples:5.1f}%  {frame}'
+                         for frame, count, total in hotspots] if nsamples else list()
+                log.info('CPU hotspots ({} samples of busy threads, own% total%):\n{}'.format(nsamples, '\n'.join(lines)))
+
+            if self.memory:
+                self._track_memory()
+                current, peak = tracemalloc.get_traced_memory()
+                peak_allocations = list()
+                if os.path.exists(self._get_name('-peak.tracemalloc')):
+                    files.append(self._get_name('-peak.tracemalloc'))
+                    snapshot = tracemalloc.Snapshot.load(files[-1])
+                    peak_allocations = [{'line': self._describe(stat.traceback), 'size': stat.size, 'count': stat.count}
+                                        for stat in snapshot.statistics('traceback')[:PROFILE_TOP]]
+                phases = OrderedDict((name, dict(phase, allocations=[{'line': line, 'size_diff': size}
+                                                                     for line, size in phase['allocations'].most_common(PROFILE_TOP)]))
+                                     for name, phase in self.phases.items())
+                files.append(self._get_name('-memory.json'))
+                with open(files[-1], 'w') as mf:
+                    json.dump({'peak_memory': peak, 'final_memory': current, 'peak_allocations': peak_allocations,
+                               'phases': phases}, mf, indent=4)
+
+                log.info('Memory: {} peak traced, by phase: {}. Largest allocations at the peak:\n{}'.format(
+                    format_size(peak), ', '.join(f'{name}={format_size(phase["peak_memory"])}' for name, phase in phases.items()),
+                    '\n'.join(f'{format_size(a["size"]):>10}  {a["line"]}' for a in peak_allocations)))
+        except Exception:
+            # Profiling must never fail the run it profiles
+            log.exception('Could not save the profiling results')
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+            self.cpu = self.memory = False
+        log.info('Profiling results saved: {}'.format(', '.join(os.path.basename(f) for f in files)))
+        return files
+
+
+PROFILER = RunProfiler()
+
+
+class RunMetrics(object):
+    """Per-phase metrics of a run: wall time, API calls by endpoint, retries,
+    reads served from the read cache (see `ApiExecutor.read`) and bytes
+    transferred.
+
+    Phases may be nested: the wall time of a phase includes its nested phases,
+    while API calls and transfers are attributed to the innermost phase. Work
+    done by worker threads (see `map_concurrently`) is attributed to the phase
+    of the thread which started it. `phase` can also be used as a function
+    decorator.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard all recorded metrics."""
+        with self._lock:
+            self.started = time.time()
+            self.phases = OrderedDict()
+
+    def _get_phase(self, name):
+        return self.phases.setdefault(name, {'count': 0, 'wall_time': 0.0, 'api_calls': Counter(),
+                                             'retries': Counter(), 'cached_reads': Counter(),
+                                             'bytes_downloaded': 0, 'bytes_uploaded': 0})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager recording the enclosed work as phase <name>."""
+        token = CURRENT_PHASE.set(name)
+        start = time.time()
+        try:
+            with PROFILER.phase(name):
+                yield
+        finally:
+            CURRENT_PHASE.reset(token)
+            with self._lock:
+                phase = self._get_phase(name)
+                phase['count'] += 1
+                phase['wall_time'] += time.time() - start
+
+    def record_call(self, endpoint, retry=False, cached=False):
+        """Count an API call (or a retry of one, or a read served from the read
+        cache) to <endpoint> in the current phase."""
+        counter = 'retries' if retry else 'cached_reads' if cached else 'api_calls'
+        with self._lock:
+            self._get_phase(CURRENT_PHASE.get() or 'other')[counter][endpoint] += 1
+
+    def add_bytes(self, direction, nbytes):
+        """Add <nbytes> to the bytes transferred in <direction> ('downloaded' or 'uploaded')."""
+        with self._lock:
+            self._get_phase(CURRENT_PHASE.get() or 'other')['bytes_' + direction] += nbytes
+
+    def to_dict(self, **info):
+        """Return the metrics as a dict, including the extra <info> fields."""
+        with self._lock:
+            phases = copy.deepcopy(self.phases)
+        for phase in phases.values():
+            phase['wall_time'] = round(phase['wall_time'], 3)
+            phase['total_api_calls'] = sum(phase['api_calls'].values())
+            phase['total_retries'] = sum(phase['retries'].values())
+            phase['total_cached_reads'] = sum(phase['cached_reads'].values())
+        metrics = dict(info)
+        metrics['started'] = time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started))
+        metrics['wall_time'] = round(time.time() - self.started, 3)
+        metrics['api_calls'] = sum(p['total_api_calls'] for p in phases.values())
+        metrics['retries'] = sum(p['total_retries'] for p in phases.values())
+        metrics['cached_reads'] = sum(p['total_cached_reads'] for p in phases.values())
+        metrics['bytes_downloaded'] = sum(p['bytes_downloaded'] for p in phases.values())
+        metrics['bytes_uploaded'] = sum(p['bytes_uploaded'] for p in phases.values())
+        metrics['phases'] = phases
+        return metrics
+
+    def save(self, filename, **info):
+        """Write the metrics to a JSON file.
+
+        Returns:
+            str: Full path to the metrics file.
+
+        """
+
+        with open(filename, 'w') as mf:
+            json.dump(self.to_dict(**info), mf, indent=4)
+        return filename
+
+    def summary(self):
+        """Return a one line summary of the metrics, for the log."""
+        metrics = self.to_dict()
+        phases = ', '.join(f'{name}={phase["wall_time"]:.1f}s' for name, phase in metrics['phases'].items())
+        return (f'Run metrics: {metrics["wall_time"]:.1f}s, {metrics["api_calls"]} API calls '
+                f'({metrics["retries"]} retries, {metrics["cached_reads"]} reads from cache), '
+                f'{format_size(metrics["bytes_downloaded"])} downloaded, '
+                f'{format_size(metrics["bytes_uploaded"])} uploaded [{phases}]')
+
+
+METRICS = RunMetrics()
+
+
+def map_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """Return `[func(item) for item in items]`, computed by up to <max_workers> threads.
+
+    Each call runs in a copy of the caller's context, so that its API calls are
+    attributed to the caller's phase (see RunMetrics).
+
+    Args:
+        func (callable): Function of one argument.
+        items (iterable): Arguments.
+        max_workers (int): Maximum number of threads. Defaults to DEFAULT_MAX_WORKERS.
+
+    Returns:
+        list: Results, in the order of <items>.
+
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+class Plan(object):
+    """Operations which apply a template to a project, with their dependencies.
+
+    An operation runs once every operation it depends on has completed, and
+    is skipped if any of them did not succeed (unless it was added with
+    always=True). `execute` runs independent operations concurrently, with
+    transfers in a pool of their own, so that API calls never wait for
+    unrelated uploads. Each operation runs in (a copy of) the context in which
+    it was added, so that its API calls are attributed to the phase which
+    planned it (see RunMetrics).
+
+    The plan, and after execution the outcome of every operation, can be saved
+    as JSON (see config.dry_run).
+
+    Args:
+        project (:obj: flywheel.models.project.Project): Project to which the
+            plan applies.
+
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.operations = OrderedDict()
+
+    def add(self, kind, target, func, depends_on=(), always=False, transfer=False, **details):
+        """Add an operation to the plan.
+
+        Args:
+            kind (str): Operation kind (e.g. 'permission', 'upload', 'rule_add').
+            target (str): What the operation applies to (e.g. a user or file name).
+            func (callable): Function of no arguments performing the operation,
+                which raises an exception on failure.
+            depends_on (iterable, optional): Ids of the operations which must
+                complete first. Defaults to ().
+            always (bool, optional): Run even if a dependency did not succeed.
+                Defaults to False.
+            transfer (bool, optional): The operation is a file transfer.
+                Defaults to False.
+            **details: JSON serializable details, saved with the plan.
+
+        Returns:
+            str: Operation id.
+
+        """
+
+        op_id = f'{kind}:{target}'
+        if op_id in self.operations:
+            op_id = f'{op_id}#{len(self.operations)}'
+        self.operations[op_id] = {'id': op_id, 'kind': kind, 'target': target, 'depends_on': list(depends_on),
+                                  'always': always, 'transfer': transfer, 'details': details, 'status': 'planned',
+                                  'error': None, 'elapsed': None, '_func': func, '_context': contextvars.copy_context()}
+        return op_id
+
+    def to_dict(self):
+        """Return the JSON serializable form of the plan."""
+        counts = Counter(op['status'] for op in self.operations.values())
+        return {'project_id': self.project.id, 'project': f'{self.project.group}/{self.project.label}',
+                'counts': dict(counts), 'operations': [{k: v for k, v in op.items() if not k.startswith('_')}
+                                                       for op in self.operations.values()]}
+
+    def save(self, filename):
+        """Save the plan to a JSON file, and return its path."""
+        with open(filename, 'w') as pf:
+            json.dump(self.to_dict(), pf, indent=4, default=str)
+        return filename
+
+    def _run(self, op):
+        start = time.time()
+        try:
+            op['_func']()
+            op['status'] = 'done'
+        except flywheel.ApiException as err:
+            op['status'] = 'failed'
+            op['error'] = f'{err.status} -- {err.reason} -- {err.detail}'
+            log.error(f'API error during {op["id"]}: {op["error"]}')
+        except ValueError as err:
+            op['status'] = 'failed'
+            op['error'] = str(err)
+            log.error(f'Error during {op["id"]}: {err}')
+        except Exception as err:
+            op['status'] = 'failed'
+            op['error'] = repr(err)
+            log.exception(f'Error during {op["id"]}')
+        op['elapsed'] = round(time.time() - start, 3)
+
+    @METRICS.phase('execute_plan')
+    def execute(self, max_workers=DEFAULT_MAX_WORKERS):
+        """Run the operations of the plan.
+
+        Args:
+            max_workers (int): Maximum number of concurrent API operations, and
+                of concurrent transfers. Defaults to DEFAULT_MAX_WORKERS.
+
+        Returns:
+            int: Number of operations which failed or were skipped.
+
+        """
+
+        pending = OrderedDict(self.operations)
+        running = dict()
+        with ThreadPoolExecutor(max_workers=max_workers) as api_pool, \
+                ThreadPoolExecutor(max_workers=max_workers) as transfer_pool:
+            while pending or running:
+                progress = False
+                for op in list(pending.values()):
+                    dependencies = [self.operations[d] for d in op['depends_on']]
+                    if any(d['status'] in ('planned', 'running') for d in dependencies):
+                        continue
+                    del pending[op['id']]
+                    progress = True
+                    if not op['always'] and any(d['status'] != 'done' for d in dependencies):
+                        op['status'] = 'skipped'
+                        op['error'] = 'Skipped, as {} did not succeed'.format(
+                            ', '.join(d['id'] for d in dependencies if d['status'] != 'done'))
+                        log.warning(f'{op["id"]}: {op["error"]}')
+                        continue
+                    op['status'] = 'running'
+                    pool = transfer_pool if op['transfer'] else api_pool
+                    running[pool.submit(op['_context'].copy().run, self._run, op)] = op
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future)
+                elif pending and not progress:
+                    for op in pending.values():
+                        op['status'] = 'skipped'
+                        op['error'] = 'Skipped, as its dependencies can never complete'
+                    pending.clear()
+
+        counts = Counter(op['status'] for op in self.operations.values())
+        log.info(f'Executed plan for {self.project.label}: {counts["done"]} operations done, '
+                 f'{counts["failed"]} failed, {counts["skipped"]} skipped')
+        return counts['failed'] + counts['skipped']
+
+
+# Transient HTTP errors which are retried. Operations which are not idempotent
+# (e.g. adding a rule) are only retried when the request was refused outright.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+WRITE_RETRY_STATUSES = (429, 503)
+
+
+def get_error_status(err):
+    """Return the HTTP status of an API or requests error, or None for connection errors."""
+    if isinstance(err, flywheel.ApiException):
+        return err.status
+    response = getattr(err, 'response', None)
+    return response.status_code if response is not None else None
+
+
+def accepts_kwargs(func):
+    """Return whether <func> takes arbitrary keyword arguments (e.g. the SDK's
+    _request_timeout). Some SDK methods, such as `Client.lookup`, take none."""
+    return _accepts_kwargs(getattr(func, '__func__', func))
+
+
+@functools.lru_cache(maxsize=None)
+def _accepts_kwargs(func):
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
+class ApiExecutor(object):
+    """Execution layer for all API operations of the gear.
+
+    Every operation goes through `call` (reads and idempotent writes), `write`
+    (non-idempotent writes) or `transfer` (file uploads), which:
+        - retry transient errors (429/5xx and connection errors) with exponential
+          backoff and jitter, honouring Retry-After headers;
+        - bound the number of operations in flight. The limit is halved whenever
+          the platform throttles us (HTTP 429) and grows back by one every
+          `limit` successful operations (AIMD). Transfers, which hold a slot for
+          as long as the file takes to upload, are bounded separately by
+          `max_transfers`, so that API calls never queue behind them;
+        - pass a timeout (in seconds) to the SDK calls which take one.
+
+    Reads of resources which only change when the gear itself changes them go
+    through `read`, which memoizes them for the run and shares one request
+    between concurrent callers. Code making a write calls `invalidate` for the
+    reads it affects.
+
+    Args:
+        max_retries (int): Maximum number of retries of an operation. Defaults to 5.
+        backoff (float): Delay before the first retry, in seconds, doubled on
+            every subsequent retry. Defaults to 1.
+        max_backoff (float): Maximum delay between retries. Defaults to 60.
+        timeout (float): Timeout of SDK calls, in seconds. 0 uses the SDK
+            default. Defaults to 0.
+        max_concurrency (int): Maximum number of operations in flight. Defaults
+            to 16.
+        max_transfers (int): Maximum number of transfers in flight. Defaults to
+            4.
+
+    """
+
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0, timeout=0, max_concurrency=16, max_transfers=4):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.max_transfers = max_transfers
+        self.active_transfers = 0
+        self.calls = Counter()
+        self.retries = Counter()
+        self.cached_reads = Counter()
+        self._reads = dict()  # (client, endpoint, arguments) -> Future
+        self._cond = threading.Condition()
+
+    def configure_session(self, fw, pool_size):
+        """Size the connection pools of the SDK session, and of the session used for
+        file transfers, for <pool_size> concurrent requests.
+
+        Transport-level retries of the SDK session are disabled, as they are
+        handled (and accounted for) by this executor.
+
+        Args:
+            fw (:obj:flywheel.Client): Flywheel client.
+            pool_size (int): Number of pooled connections per host.
+
+        """
+
+        sessions = [get_http_session()]
+        try:
+            sessions.append(fw.api_client.rest_client.session)
+        except AttributeError:
+            log.debug('Could not access the SDK session, leaving its connection pool as is.')
+        for session in sessions:
+            if session is None:
+                continue
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+    def _acquire(self, transfer):
+        with self._cond:
+            if transfer:
+                while self.active_transfers >= max(1, self.max_transfers):
+                    self._cond.wait()
+                self.active_transfers += 1
+                return
+            while self.active >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.active += 1
+
+    def _release(self, throttled, transfer):
+        with self._cond:
+            if transfer:
+                self.active_transfers -= 1
+            else:
+                self.active -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                log.warning(f'API is throttling requests. Reducing concurrency to {int(self.limit)}')
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _get_delay(self, err, attempt):
+        headers = getattr(err, 'headers', None) or getattr(getattr(err, 'response', None), 'headers', None) or dict()
+        try:
+            return min(float(headers.get('Retry-After')), self.max_backoff)
+        except (TypeError, ValueError):
+            return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+
+    def call(self, func, *args, **kwargs):
+        """Execute an idempotent operation: `func(*args, **kwargs)`.
+
+        Returns:
+            The return value of <func>.
+
+        Raises:
+            flywheel.ApiException: If the operation failed after all retries.
+
+        """
+
+        return self._execute(func, args, kwargs, RETRY_STATUSES, True)
+
+    def write(self, func, *args, **kwargs):
+        """Execute an operation which is not idempotent: `func(*args, **kwargs)`.
+
+        Returns:
+            The return value of <func>.
+
+        Raises:
+            flywheel.ApiException: If the operation failed after all retries.
+
+        """
+
+        return self._execute(func, args, kwargs, WRITE_RETRY_STATUSES, False)
+
+    def transfer(self, func, *args, **kwargs):
+        """Execute a file upload, which is not idempotent: `func(*args, **kwargs)`.
+
+        Uploads are bounded by `max_transfers` instead of the limit of API
+        operations (see `write`).
+
+        Returns:
+            The return value of <func>.
+
+        Raises:
+            flywheel.ApiException: If the operation failed after all retries.
+
+        """
+
+        return self._execute(func, args, kwargs, WRITE_RETRY_STATUSES, False, transfer=True)
+
+    def read(self, func, *args, **kwargs):
+        """Execute a read-only operation through the read cache: `func(*args, **kwargs)`.
+
+        The result is memoized per client, endpoint and arguments until it is
+        invalidated, and concurrent callers of the same read share a single
+        request. Not found (404) errors are memoized too, other errors are not.
+        Results are shared between callers, which must not modify them.
+
+        Returns:
+            The return value of <func>.
+
+        Raises:
+            flywheel.ApiException: If the operation failed after all retries.
+
+        """
+
+        endpoint = getattr(func, '__name__', repr(func))
+        key = (id(getattr(func, '__self__', None)), endpoint, json.dumps([args, kwargs], sort_keys=True, default=str))
+        with self._cond:
+            future = self._reads.get(key)
+            owner = future is None
+            if owner:
+                future = self._reads[key] = Future()
+            else:
+                self.cached_reads[endpoint] += 1
+        if not owner:
+            METRICS.record_call(endpoint, cached=True)
+            return future.result()
+
+        try:
+            result = self.call(func, *args, **kwargs)
+        except Exception as err:
+            if get_error_status(err) != 404:
+                with self._cond:
+                    if self._reads.get(key) is future:
+                        del self._reads[key]
+            future.set_exception(err)
+            raise
+        future.set_result(result)
+        return result
+
+    def invalidate(self, endpoint, *args):
+        """Drop the cached reads of <endpoint> (e.g. 'get_project_rules') made
+        with <args>, or all of them if no <args> are given, on every client."""
+        arguments = json.dumps([args, dict()], sort_keys=True, default=str)
+        with self._cond:
+            for key in [k for k in self._reads if k[1] == endpoint and (not args or k[2] == arguments)]:
+                del self._reads[key]
+
+    def _execute(self, func, args, kwargs, retry_statuses, retry_connection_errors, transfer=False):
+        endpoint = getattr(func, '__name__', repr(func))
+        if self.timeout and hasattr(getattr(func, '__self__', None), 'api_client') and accepts_kwargs(func):
+            kwargs.setdefault('_request_timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            self._acquire(transfer)
+            throttled = False
+            try:
+                with self._cond:
+                    self.calls[endpoint] += 1
+                METRICS.record_call(endpoint)
+                return func(*args, **kwargs)
+            except (flywheel.ApiException, requests.RequestException) as err:
+                status = get_error_status(err)
+                throttled = status == 429
+                retryable = status in retry_statuses or (
+                    status is None and retry_connection_errors and
+                    isinstance(err, (requests.ConnectionError, requests.Timeout)))
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._get_delay(err, attempt)
+            finally:
+                self._release(throttled, transfer)
+
+            attempt += 1
+            with self._cond:
+                self.retries[endpoint] += 1
+            METRICS.record_call(endpoint, retry=True)
+            log.warning(f'{endpoint} failed ({status or "connection error"}), retrying in {delay:.1f}s '
+                        f'(attempt {attempt}/{self.max_retries})')
+            time.sleep(delay)
+
+
+API = ApiExecutor()
+
+
+class GearCache(object):
+    """Cache of gear documents keyed by gear id and by gear name/version.
+
+    Gear documents are kept in memory for the duration of the run, so that
+    rules sharing a gear only cost a single API call. The cache can be saved
+    to, and loaded from, a JSON file so that subsequent runs against the same
+    instance can skip the gear API calls entirely. Loaded entries older than
+    `ttl` seconds are ignored (all of them if `ttl` is 0), and the least
+    recently used entries are evicted once `max_entries` is reached. Entries
+    fetched by the run itself are valid for the whole run.
+
+    Gears which could not be found are remembered for the run (but never
+    persisted), so that a missing gear only costs one failed lookup.
+
+    Args:
+        ttl (int): Maximum age (in seconds) of a loaded entry. Defaults to 86400.
+        max_entries (int): Maximum number of gears held in the cache. Defaults
+            to 2048.
+
+    """
+
+    def __init__(self, ttl=86400, max_entries=2048):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.started = time.time()
+        self.hits = 0
+        self.misses = 0
+        self._by_id = OrderedDict()  # gear_id -> {'id', 'gear', 'cached_at'}
+        self._by_name = dict()       # (name, version) -> gear_id
+        self._missing = dict()       # gear_id or (name, version) -> ApiException
+        self._index = None           # name -> {version: entry}, set by index_installed
+        self._index_by_id = dict()   # gear_id -> entry, set by index_installed
+        self._lock = threading.RLock()
+
+    def _expired(self, entry):
+        # Only entries cached before the run (i.e. loaded from a file) expire
+        return entry['cached_at'] < self.started and (time.time() - entry['cached_at']) >= self.ttl
+
+    def _store(self, gear_doc, cached_at=None):
+        """Add a gear document (SDK object or dict) to the cache and return it as a dict."""
+        if isinstance(gear_doc, dict):
+            entry = {'id': gear_doc['id'], 'gear': gear_doc['gear']}
+        else:
+            entry = {'id': gear_doc.id, 'gear': gear_doc.gear.to_dict()}
+        entry['cached_at'] = cached_at or time.time()
+        with self._lock:
+            self._by_id[entry['id']] = entry
+            self._by_id.move_to_end(entry['id'])
+            self._by_name[(entry['gear']['name'], entry['gear']['version'])] = entry['id']
+            while len(self._by_id) > self.max_entries:
+                _, evicted = self._by_id.popitem(last=False)
+                self._by_name.pop((evicted['gear']['name'], evicted['gear']['version']), None)
+        return entry
+
+    def _cached(self, gear_id):
+        with self._lock:
+            entry = self._by_id.get(gear_id)
+            if entry is None:
+                return None
+            if self._expired(entry):
+                del self._by_id[gear_id]
+                return None
+            self._by_id.move_to_end(gear_id)
+            self.hits += 1
+            return entry
+
+    def __contains__(self, gear_id):
+        with self._lock:
+            return gear_id in self._index_by_id or (gear_id in self._by_id and not self._expired(self._by_id[gear_id]))
+
+    def index_installed(self, fw):
+        """List every installed gear (all versions, including gears flagged
+        invalid) with a single API call.
+
+        Once indexed, `get` and `lookup` serve the gears of the index without
+        calling the API. A gear which is not in the index (e.g. left out of a
+        truncated listing) is still looked up on its own, once per run.
+
+        Args:
+            fw (:obj:flywheel.Client): Flywheel client.
+
+        """
+
+        if self._index is not None:
+            return
+        index = dict()
+        index_by_id = dict()
+        for gear_doc in API.read(fw.get_all_gears, all_versions=True, include_invalid=True):
+            entry = self._store(gear_doc)
+            index.setdefault(entry['gear']['name'], dict())[entry['gear']['version']] = entry
+            index_by_id[entry['id']] = entry
+        with self._lock:
+            self._index = index
+            self._index_by_id = index_by_id
+        log.info(f'Indexed {len(index_by_id)} installed gears ({len(index)} distinct names)')
+
+    def get_versions(self, name):
+        """Return the installed versions of gear <name> (requires `index_installed`), oldest first."""
+        return sorted((self._index or dict()).get(name, dict()), key=version_key)
+
+    def get(self, fw, gear_id):
+        """Return the gear document for <gear_id>, calling the API only on a cache miss.
+
+        Args:
+            fw (:obj:flywheel.Client): Flywheel client.
+            gear_id (str): Gear ID.
+
+        Returns:
+            dict: Gear document, {'id': <gear_id>, 'gear': <gear_manifest>}.
+
+        Raises:
+            flywheel.ApiException: If the gear could not be retrieved.
+
+        """
+
+        entry = self._cached(gear_id)
+        if entry:
+            return entry
+        if gear_id in self._index_by_id:
+            return self._index_by_id[gear_id]
+        if gear_id in self._missing:
+            raise self._missing[gear_id]
+        self.misses += 1
+        try:
+            return self._store(API.read(fw.get_gear, gear_id))
+        except flywheel.ApiException as err:
+            if err.status == 404:
+                self._missing[gear_id] = err
+            raise
+
+    def lookup(self, fw, name, version):
+        """Return the gear document for <name>/<version>, calling the API only on a cache miss.
+
+        Args:
+            fw (:obj:flywheel.Client): Flywheel client.
+            name (str): Gear name.
+            version (str): Gear version.
+
+        Returns:
+            dict: Gear document, {'id': <gear_id>, 'gear': <gear_manifest>}.
+
+        Raises:
+            flywheel.ApiException: If the gear is not installed on this instance.
+
+        """
+
+        key = (name, version)
+        with self._lock:
+            gear_id = self._by_name.get(key)
+        if gear_id:
+            entry = self._cached(gear_id)
+            if entry:
+                return entry
+        if version in (self._index or dict()).get(name, dict()):
+            return self._index[name][version]
+        if key in self._missing:
+            raise self._missing[key]
+        self.misses += 1
+        try:
+            return self._store(API.read(fw.lookup, 'gears/{}/{}'.format(name, version)))
+        except flywheel.ApiException as err:
+            if err.status == 404:
+                self._missing[key] = err
+            raise
+
+    def load(self, filename, host=None):
+        """Load cache entries from a JSON file written by `save`.
+
+        Entries from another instance (<host>), or older than the ttl, are ignored.
+
+        Args:
+            filename (str): Full path to the cache file.
+            host (str, optional): Host of the current instance. Defaults to None.
+
+        Returns:
+            int: Number of entries loaded.
+
+        """
+
+        try:
+            with open(filename, 'r') as cf:
+                data = json.load(cf)
+        except (OSError, ValueError) as err:
+            log.warning(f'Could not read gear cache {filename}: {err}')
+            return 0
+
+        if data.get('version') != GEAR_CACHE_VERSION or (host and data.get('host') != host):
+            log.info(f'Gear cache {filename} does not match this instance. Ignoring.')
+            return 0
+
+        loaded = 0
+        for entry in sorted(data.get('gears', []), key=lambda x: x['cached_at']):
+            if not self._expired(entry):
+                self._store(entry, entry['cached_at'])
+                loaded += 1
+        log.info(f'Loaded {loaded} gears from cache {filename}')
+        return loaded
+
+    def save(self, filename, host=None):
+        """Write the (unexpired) cache entries to a JSON file.
+
+        Args:
+            filename (str): Full path for the cache file.
+            host (str, optional): Host of the current instance. Defaults to None.
+
+        Returns:
+            str: Full path to the cache file.
+
+        """
+
+        with self._lock:
+            gears = [e for e in self._by_id.values() if not self._expired(e)]
+        with open(filename, 'w') as cf:
+            json.dump({'version': GEAR_CACHE_VERSION, 'host': host, 'gears': gears}, cf)
+        log.info(f'Saved {len(gears)} gears to cache {filename} (hits={self.hits}, misses={self.misses})')
+        return filename
+
+
+GEAR_CACHE = GearCache()
+
+
+class OperationJournal(object):
+    """Record of the operations completed while applying a template, so that a
+    rerun after a failed (or killed) run can skip the work already done.
+
+    Each completed operation is appended to a JSON lines file as soon as it is
+    done, keyed by (project id, operation, key):
+        - 'upload': fixed input file uploaded, with its size, CRC and sha384.
+        - 'permission': permission granted to a user, with its roles.
+        - 'rule_add', 'rule_update', 'rule_delete': gear rule changes.
+        - 'step': a whole step ('permissions', 'fixed_inputs' or 'gear_rules')
+          completed without errors, with a digest of what was applied.
+
+    The journal of a previous run is loaded with `load`, and its entries are
+    carried over to the new journal file so that journals chain across reruns.
+
+    """
+
+    def __init__(self):
+        self.filename = None
+        self.loaded = 0
+        self._entries = OrderedDict()  # (project_id, operation, key) -> entry
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def load(self, filename):
+        """Load the entries of a journal written by a previous run. A truncated
+        last line (the run was killed while writing it) is ignored."""
+        with open(filename) as jf:
+            for line in jf:
+                try:
+                    entry = json.loads(line)
+                    self._entries[(entry['project_id'], entry['operation'], entry['key'])] = entry
+                except (ValueError, KeyError):
+                    log.warning(f'Ignoring invalid journal entry: {line.strip()}')
+        self.loaded = len(self._entries)
+        log.info(f'Loaded {self.loaded} operations from journal {filename}')
+
+    def open(self, filename):
+        """Start writing the journal to <filename>, beginning with the loaded entries."""
+        with self._lock:
+            self.filename = filename
+            self._fp = open(filename, 'w')
+            for entry in self._entries.values():
+                self._fp.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._fp = None
+
+    def get(self, project_id, operation, key):
+        """Return the journal entry for an operation, or None if it was not recorded."""
+        with self._lock:
+            return self._entries.get((project_id, operation, key))
+
+    def is_done(self, project_id, operation, key, **details):
+        """Return True if the operation was recorded with the same <details>."""
+        entry = self.get(project_id, operation, key)
+        return entry is not None and all(entry.get(k) == v for k, v in details.items())
+
+    def record(self, project_id, operation, key, **details):
+        """Record a completed operation, flushing it to the journal file at once."""
+        entry = dict(details, project_id=project_id, operation=operation, key=key, time=time.time())
+        with self._lock:
+            self._entries[(project_id, operation, key)] = entry
+            if self._fp:
+                self._fp.write(json.dumps(entry, sort_keys=True) + '\n')
+                self._fp.flush()
+
+
+JOURNAL = OperationJournal()
+
+
+def get_digest(data):
+    """Return a short digest of JSON serializable <data>, used to tell whether a
+    journaled step applied the same content."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def version_key(version):
+    """Return a sort key for a gear version string (e.g. '1.10.2_3.1' > '1.9.0')."""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'[.\-_+]', version or '')]
+
+
+def get_nearest_versions(version, versions, count=3):
+    """Return up to <count> of <versions> closest to <version>, nearest first."""
+    ordered = sorted(set(versions) | {version}, key=version_key)
+    position = ordered.index(version)
+    return sorted([v for v in ordered if v != version],
+                  key=lambda v: abs(ordered.index(v) - position))[:count]
+
+
+def resolve_template_gears(fw, rules):
+    """Map the gear id of every template rule to the id of the same gear on this instance.
+
+    Gears are matched by id first and by name/version otherwise (i.e. when the
+    template comes from another instance). If any gear is not already cached,
+    every installed gear is listed once and all rules are resolved against that
+    index, instead of making API calls per rule. Only gears which are not in
+    the index are looked up individually, once each. Missing gears are
+    reported together, with the nearest installed versions.
+
+    Args:
+        fw (:obj:flywheel.Client): Flywheel client.
+        rules (list): Template rule dicts (with 'gear_id' and 'gear' keys).
+
+    Returns:
+        dict: Template gear id -> gear id on this instance. Gears which could
+            not be found are omitted.
+
+    """
+
+    gears = OrderedDict((rule['gear_id'], rule.get('gear') or dict()) for rule in rules)
+    if any(gear_id not in GEAR_CACHE for gear_id in gears):
+        GEAR_CACHE.index_installed(fw)
+
+    resolved = dict()
+    missing = list()
+    for gear_id, gear in gears.items():
+        try:
+            resolved[gear_id] = GEAR_CACHE.get(fw, gear_id)['id']
+            log.info('Found {},{}:{}'.format(gear_id, gear.get('name'), gear.get('version')))
+            continue
+        except flywheel.ApiException:
+            log.warning('Gear ID {} cannot be found on this system!'.format(gear_id))
+        try:
+            resolved[gear_id] = GEAR_CACHE.lookup(fw, gear['name'], gear['version'])['id']
+            log.info('Found {}:{} locally (id={})'.format(gear['name'], gear['version'], resolved[gear_id]))
+        except (flywheel.ApiException, KeyError):
+            missing.append(gear)
+
+    for gear in missing:
+        candidates = get_nearest_versions(gear.get('version'), GEAR_CACHE.get_versions(gear.get('name')))
+        log.error('{}:{} was not found on this system! Please install it! {}'.format(
+            gear.get('name'), gear.get('version'),
+            'Installed versions: {}'.format(', '.join(candidates)) if candidates else 'No version is installed.'))
+    if missing:
+        log.error(f'{len(missing)} of {len(gears)} gears used by the template are missing. '
+                  'Rules using these gears will be skipped.')
+
+    return resolved
+
+
+def get_gear_version():
+    """Return the version of this gear, from its manifest."""
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manifest.json')) as mf:
+            return json.load(mf).get('version')
+    except (OSError, ValueError):
+        return None
+
+
+def get_instance_host(fw):
+    """Return the API host of the client's instance (used to key instance-specific caches)."""
+    try:
+        return fw.api_client.configuration.host
+    except AttributeError:
+        return None
+
+
+def format_size(nbytes):
+    """Return a human readable string for a number of bytes (e.g. '1.5 GB')."""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nbytes) < 1024.0:
+            return f'{nbytes:.1f} {unit}'
+        nbytes /= 1024.0
+    return f'{nbytes:.1f} TB'
+
+
+def get_http_session():
+    """Return the HTTP session used for file transfers outside of the SDK."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        _HTTP_SESSION = requests.Session()
+    return _HTTP_SESSION
+
+
+def get_file_entry(container, file_name):
+    """Return the file entry named <file_name> on <container>, or None if not found."""
+    for file_entry in container.files or []:
+        if file_entry.name == file_name:
+            return file_entry
+    return None
+
+
+class RangeNotSupportedError(Exception):
+    """The server ignored a Range request (answered 200 instead of 206)."""
+
+
+def get_download_url(container, file_name):
+    """Return a ticketed download url for <file_name> of <container>.
+
+    The url is requested with view=true, without which the platform ignores
+    the Range header of requests (see `fetch_range`).
+
+    """
+
+    url = API.call(container.get_file_download_url, file_name)
+    scheme, netloc, path, query, fragment = urllib.parse.urlsplit(url)
+    params = [(k, v) for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True) if k != 'view']
+    return urllib.parse.urlunsplit((scheme, netloc, path, urllib.parse.urlencode(params + [('view', 'true')]), fragment))
+
+
+def fetch_range(url, start, end):
+    """Return bytes <start> to <end> (inclusive) of the file at <url>.
+
+    Incomplete responses raise a requests.ConnectionError, so that
+    `ApiExecutor.call` retries them like any other dropped connection.
+
+    Raises:
+        RangeNotSupportedError: If the server does not honour the Range header.
+
+    """
+
+    # Streamed, so that a server ignoring the Range header does not send the whole file
+    length = end - start + 1
+    chunks = list()
+    received = 0
+    try:
+        with get_http_session().get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True,
+                                    timeout=(10, API.timeout or 60)) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise RangeNotSupportedError(url)
+            for chunk in resp.iter_content(min(length, CHUNK_SIZE)):
+                chunks.append(chunk[:length - received])
+                received += len(chunks[-1])
+                if received >= length:
+                    break
+    except requests.exceptions.ChunkedEncodingError as err:
+        raise requests.ConnectionError(f'Incomplete response for bytes {start}-{end}: {err}')
+    if received != length:
+        raise requests.ConnectionError(f'Incomplete response for bytes {start}-{end}: got {received} bytes')
+    return b''.join(chunks)
+
+
+def iter_file_download(container, file_name, chunk_size=CHUNK_SIZE, size=None, parallel=1, offset=0):
+    """Stream a file from a container, yielding chunks of at most <chunk_size> bytes.
+
+    When the <size> of the file is known, it is fetched as byte ranges of
+    <chunk_size> bytes, up to <parallel> ranges at a time, and yielded in
+    order. Each range is retried on its own, so a dropped connection only costs
+    the range in flight, and memory use is bounded by <parallel> x <chunk_size>.
+    Servers which do not support range requests are read as a single stream.
+
+    Args:
+        container (:obj:flywheel.models.container.Container): Container the file
+            is attached to.
+        file_name (str): Name of the file.
+        chunk_size (int): Maximum chunk (and range) size in bytes. Defaults to
+            CHUNK_SIZE.
+        size (int, optional): Size of the file. Defaults to None (single stream).
+        parallel (int): Maximum number of ranges fetched concurrently. Defaults to 1.
+        offset (int): Position to start from (to resume a partial download).
+            Defaults to 0.
+
+    Yields:
+        bytes: File content.
+
+    """
+
+    def open_stream(url):
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        resp = get_http_session().get(url, headers=headers, stream=True, timeout=(10, API.timeout or 60))
+        resp.raise_for_status()
+        if offset and resp.status_code != 206:
+            resp.close()
+            raise RangeNotSupportedError(url)
+        return resp
+
+    url = [get_download_url(container, file_name)]
+    url_lock = threading.Lock()
+
+    def fetch(byte_range):
+        # Download urls carry a short-lived ticket, a new one is requested when it expires
+        current = url[0]
+        try:
+            return API.call(fetch_range, current, *byte_range)
+        except requests.HTTPError as err:
+            if get_error_status(err) not in (400, 401, 403, 404):
+                raise
+            with url_lock:
+                if url[0] == current:
+                    log.debug(f'Download url of {file_name} expired, requesting a new one')
+                    url[0] = get_download_url(container, file_name)
+            return API.call(fetch_range, url[0], *byte_range)
+
+    if size is not None:
+        ranges = [(start, min(start + chunk_size, size) - 1) for start in range(offset, size, chunk_size)]
+        try:
+            first = fetch(ranges[0]) if ranges else None
+        except RangeNotSupportedError:
+            if offset:
+                raise
+            log.debug(f'Range requests are not supported for {file_name}, downloading as a single stream')
+        else:
+            if first is not None:
+                yield first
+            with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+                pending = deque()
+                for byte_range in ranges[1:]:
+                    pending.append(pool.submit(contextvars.copy_context().run, fetch, byte_range))
+                    if len(pending) >= parallel:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            return
+
+    with API.call(open_stream, url[0]) as resp:
+        for chunk in resp.iter_content(chunk_size):
+            yield chunk
+
+
+def download_to_file(container, file_name, dest, size=None, platform_hash=None, chunk_size=CHUNK_SIZE,
+                     parallel=1, max_resumes=3):
+    """Download a file to <dest> with `iter_file_download`, resuming from the
+    bytes already received when the transfer fails, and verify its content.
+
+    The file is written to <dest>.part, which is only renamed to <dest> once
+    complete and verified, so a leftover partial file (e.g. from an
+    interrupted run) is resumed rather than started over.
+
+    Args:
+        container (:obj:flywheel.models.container.Container): Container the file
+            is attached to.
+        file_name (str): Name of the file.
+        dest (str): Destination path.
+        size (int, optional): Size of the file. Defaults to None.
+        platform_hash (str, optional): Platform hash of the file, checked
+            against the downloaded content. Defaults to None.
+        chunk_size (int): Range size in bytes. Defaults to CHUNK_SIZE.
+        parallel (int): Maximum number of ranges fetched concurrently. Defaults to 1.
+        max_resumes (int): Maximum number of times the transfer is resumed.
+            Defaults to 3.
+
+    Returns:
+        str: sha384 hex digest of the file.
+
+    Raises:
+        ValueError: If the content does not match <size> or <platform_hash>.
+
+    """
+
+    part = dest + '.part'
+    if size is None and os.path.exists(part):
+        os.remove(part)
+    resumes = 0
+    while True:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if size is not None and offset > size:
+            os.remove(part)
+            offset = 0
+        digest = hashlib.sha384()
+        with open(part, 'ab+') as fp:
+            fp.seek(0)
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                digest.update(chunk)
+            if offset:
+                log.info(f' Resuming download of {file_name} at {format_size(offset)}')
+            try:
+                for chunk in iter_file_download(container, file_name, chunk_size, size, parallel, offset):
+                    fp.write(chunk)
+                    digest.update(chunk)
+                break
+            except (flywheel.ApiException, requests.RequestException) as err:
+                if resumes >= max_resumes or size is None:
+                    raise
+                resumes += 1
+                log.warning(f'Download of {file_name} failed ({err}), resuming (attempt {resumes}/{max_resumes})')
+            except RangeNotSupportedError:
+                # Only raised when resuming: the server cannot, so start over
+                if resumes >= max_resumes:
+                    raise
+                resumes += 1
+                log.warning(f'Download of {file_name} cannot be resumed (no range support), starting over '
+                            f'(attempt {resumes}/{max_resumes})')
+                fp.truncate(0)
+
+    try:
+        if size is not None and os.path.getsize(part) != size:
+            raise ValueError(f'Downloaded {file_name} has {os.path.getsize(part)} bytes, expected {size}')
+        verify_platform_hash(file_name, digest.hexdigest(), platform_hash)
+    except ValueError:
+        os.remove(part)
+        raise
+    os.replace(part, dest)
+    return digest.hexdigest()
+
+
+def get_transfer_settings(config):
+    """Return the (range size in bytes, number of parallel ranges) of file transfers, from the gear config."""
+    return config.get('transfer_range_size_mb', 16) * 1024 * 1024, config.get('transfer_parallel_ranges', 4)
+
+
+def verify_platform_hash(file_name, sha384, platform_hash):
+    """Raise a ValueError if the sha384 of transferred content does not match
+    the platform hash of the file (when the platform hash is a sha384)."""
+    algorithm, hexdigest = parse_platform_hash(platform_hash)
+    if algorithm == 'sha384' and hexdigest != sha384:
+        raise ValueError(f'Checksum of {file_name} ({sha384}) does not match the platform hash ({platform_hash})')
+
+
+class HashingReader(object):
+    """File-like wrapper computing the sha384 of the content read through it."""
+
+    def __init__(self, stream, size):
+        self._stream = stream
+        self._size = size
+        self.digest = hashlib.sha384()
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.digest.update(data)
+        return data
+
+    def tell(self):
+        return self._stream.tell()
+
+
+def parse_platform_hash(file_hash):
+    """Split a platform file hash (e.g. 'v0-sha384-<hexdigest>') into its algorithm
+    and hex digest.
+
+    Returns:
+        tuple: (algorithm, hexdigest), or (None, None) if the hash cannot be parsed.
+
+    """
+
+    parts = (file_hash or '').split('-')
+    if len(parts) == 3 and parts[0] == 'v0':
+        return parts[1], parts[2]
+    return None, None
+
+
+def hash_stream(stream, algorithm='sha384', chunk_size=CHUNK_SIZE):
+    """Return the hex digest of the content of a file-like object."""
+    digest = hashlib.new(algorithm)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+ArchiveCodec = namedtuple('ArchiveCodec', ['name', 'compress_type', 'suffix', 'compressor', 'reader'])
+ArchiveCodec.__doc__ = """Compression codec of archive members.
+
+Codecs which zip supports natively are written as regular members of
+<compress_type>. Other codecs are written as STORED members named
+<file name><suffix>, holding the compressed stream, which <reader> wraps to
+read the original content (see `open_archive_file`). <compressor> returns a
+new object with `compress` and `flush` methods producing the member data, or
+is None for STORED members.
+"""
+
+ARCHIVE_CODECS = OrderedDict([
+    ('store', ArchiveCodec('store', zipfile.ZIP_STORED, '', None, None)),
+    ('deflate', ArchiveCodec('deflate', zipfile.ZIP_DEFLATED, '',
+                             lambda: zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15), None)),
+    ('bzip2', ArchiveCodec('bzip2', zipfile.ZIP_BZIP2, '', bz2.BZ2Compressor, None)),
+    ('lzma', ArchiveCodec('lzma', zipfile.ZIP_LZMA, '', zipfile.LZMACompressor, None)),
+    ('zstd', ArchiveCodec('zstd', zipfile.ZIP_STORED, '.zst',
+                          lambda: zstandard.ZstdCompressor().compressobj(),
+                          lambda stream: zstandard.ZstdDecompressor().stream_reader(stream))),
+])
+
+
+def get_archive_codec(file_name, codec='auto'):
+    """Return the ArchiveCodec of <file_name>: already compressed files are
+    STORED, other files use <codec> ('auto' stands for deflate)."""
+    if file_name.lower().endswith(COMPRESSED_EXTENSIONS):
+        return ARCHIVE_CODECS['store']
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError('The zstd codec requires the zstandard package')
+    return ARCHIVE_CODECS['deflate' if codec == 'auto' else codec]
+
+
+def get_archive_settings(config):
+    """Return the archive codec name and the number of members compressed
+    concurrently from the gear config.
+
+    Falls back to deflate (with a warning) when config.archive_codec is zstd and
+    the optional zstandard package is not installed.
+
+    """
+
+    codec = config.get('archive_codec', 'auto')
+    if codec not in ARCHIVE_CODECS and codec != 'auto':
+        raise ValueError(f'Unknown archive codec {codec}, expected one of: auto, {", ".join(ARCHIVE_CODECS)}')
+    if codec == 'zstd' and zstandard is None:
+        log.warning('The zstandard package is not installed, archive members will be compressed with deflate instead.')
+        codec = 'deflate'
+    return codec, config.get('max_workers', DEFAULT_MAX_WORKERS)
+
+
+class StreamingArchiveWriter(object):
+    """Write a zip archive whose entries are fed from byte streams, so that
+    content never needs to be staged on disk.
+
+    The archive layout matches `create_archive`: a top-level <arcname> folder
+    holding every file, and an ARCHIVE_MANIFEST_NAME member with the size,
+    sha384, codec and member name of each file. Each entry is compressed
+    according to `get_archive_codec`.
+
+    Args:
+        zipfilepath (str): Full path of output archive.
+        arcname (str): Name for top-level folder in archive.
+        codec (str, optional): Codec of the files which are not already
+            compressed. Defaults to 'auto'.
+
+    """
+
+    def __init__(self, zipfilepath, arcname, codec='auto'):
+        self.zipfilepath = zipfilepath
+        self.arcname = arcname
+        self.codec = codec
+        self.manifest = dict()
+        self._zf = None
+
+    def __enter__(self):
+        self._zf = zipfile.ZipFile(self.zipfilepath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        dirinfo = zipfile.ZipInfo(self.arcname + '/', time.localtime()[:6])
+        dirinfo.external_attr = (0o40755 << 16) | 0x10
+        self._zf.writestr(dirinfo, b'')
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            write_archive_manifest(self._zf, self.manifest)
+        finally:
+            self._zf.close()
+
+    def add_stream(self, file_name, chunks, size=None, platform_hash=None, codec=None):
+        """Write an archive entry for <file_name> from an iterable of byte chunks.
+
+        Args:
+            file_name (str): Name of the file within the top-level folder.
+            chunks (iterable): Iterable of bytes.
+            size (int, optional): Expected size, if known. Defaults to None.
+            platform_hash (str, optional): Hash of the file on the source instance,
+                recorded in the manifest. Defaults to None.
+            codec (:obj:ArchiveCodec, optional): Codec of the entry. Defaults to
+                `get_archive_codec(file_name, self.codec)`.
+
+        Returns:
+            int: Number of (uncompressed) bytes written.
+
+        """
+
+        codec = codec or get_archive_codec(file_name, self.codec)
+        zinfo = zipfile.ZipInfo(os.path.join(self.arcname, file_name + codec.suffix), time.localtime()[:6])
+        zinfo.compress_type = codec.compress_type
+        zinfo.external_attr = 0o644 << 16
+        # Members of non-native codecs hold the compressed stream, whose size is unknown
+        if size is not None and not codec.suffix:
+            zinfo.file_size = size
+        compressor = codec.compressor() if codec.suffix else None
+        written = 0
+        digest = hashlib.sha384()
+        with self._zf.open(zinfo, 'w', force_zip64=size is None or bool(codec.suffix)) as entry:
+            for chunk in chunks:
+                entry.write(compressor.compress(chunk) if compressor else chunk)
+                digest.update(chunk)
+                written += len(chunk)
+            if compressor:
+                entry.write(compressor.flush())
+        self.manifest[file_name] = {'size': written, 'sha384': digest.hexdigest(), 'platform_hash': platform_hash,
+                                    'codec': codec.name, 'member': zinfo.filename}
+        return written
+
+    def copy_file(self, archive_path, archive_file):
+        """Copy a file of another archive as is (see `copy_archive_file`).
+
+        Returns:
+            int: Size of the (uncompressed) file.
+
+        """
+        self.manifest[archive_file.name] = copy_archive_file(archive_path, archive_file, self._zf, self.arcname)
+        return archive_file.size
+
+
+def write_archive_manifest(zf, files):
+    """Write the fixed input manifest member to an open archive.
+
+    Args:
+        zf (:obj:zipfile.ZipFile): Archive open for writing.
+        files (dict): Map of file name to {'size', 'sha384', 'platform_hash',
+            'codec', 'member'}.
+
+    """
+
+    manifest = {'version': ARCHIVE_MANIFEST_VERSION, 'files': files}
+    zf.writestr(ARCHIVE_MANIFEST_NAME, json.dumps(manifest, sort_keys=True, indent=4))
+
+
+def read_archive_manifest(zf):
+    """Return the files listed in the manifest member of an open archive, keyed
+    by file name. Archives without a manifest return an empty dict."""
+    try:
+        with zf.open(ARCHIVE_MANIFEST_NAME) as mf:
+            return json.load(mf).get('files', dict())
+    except KeyError:
+        return dict()
+
+
+ArchiveFile = namedtuple('ArchiveFile', ['name', 'member', 'codec', 'size', 'sha384', 'platform_hash'])
+ArchiveFile.__doc__ = """A file of an archive: its name, ZipInfo member, ArchiveCodec,
+(uncompressed) size, and sha384 and platform hash (None if the archive has no
+manifest)."""
+
+
+def get_archive_files(zf):
+    """Return the files (i.e. not directories, nor the manifest) of an open
+    archive as a list of ArchiveFile.
+
+    The manifest is the index of the archive, mapping each file to its member
+    and codec. Members of archives without a manifest (written by older
+    versions) are regular zip members named after the file.
+
+    """
+
+    manifest = read_archive_manifest(zf)
+    names = {entry['member']: name for name, entry in manifest.items() if entry.get('member')}
+    files = list()
+    for member in get_archive_members(zf):
+        if member.filename == ARCHIVE_MANIFEST_NAME:
+            continue
+        name = names.get(member.filename, os.path.basename(member.filename))
+        entry = manifest.get(name, dict())
+        codec = ARCHIVE_CODECS.get(entry.get('codec'), ARCHIVE_CODECS['store'])
+        if codec.name == 'zstd' and zstandard is None:
+            raise RuntimeError(f'{member.filename} is compressed with zstd, which requires the zstandard package')
+        size = entry['size'] if codec.reader else member.file_size
+        files.append(ArchiveFile(name, member, codec, size, entry.get('sha384'), entry.get('platform_hash')))
+    return files
+
+
+@contextlib.contextmanager
+def open_archive_file(zf, archive_file):
+    """Open an ArchiveFile of <zf> for reading its original (decompressed) content."""
+    with zf.open(archive_file.member) as stream:
+        yield archive_file.codec.reader(stream) if archive_file.codec.reader else stream
+
+
+def compress_file(path, codec, dest_dir=None, chunk_size=CHUNK_SIZE):
+    """Compress a file with <codec> into a temporary file.
+
+    Args:
+        path (str): Path of the file.
+        codec (:obj:ArchiveCodec): Codec, with a compressor.
+        dest_dir (str, optional): Directory of the temporary file. Defaults to
+            the default temporary directory.
+        chunk_size (int, optional): Read size. Defaults to CHUNK_SIZE.
+
+    Returns:
+        tuple: Path of the compressed data, and its CRC-32 and file size as
+            recorded by the zip member: those of the original content for
+            native codecs, of the compressed data otherwise.
+
+    """
+
+    compressor = codec.compressor()
+    fd, compressed_path = tempfile.mkstemp(suffix='.compressed', dir=dest_dir)
+    crc, size = 0, 0
+    with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            data = compressor.compress(chunk)
+            if codec.suffix:
+                chunk = data
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            dst.write(data)
+        data = compressor.flush()
+        dst.write(data)
+        if codec.suffix:
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+    return compressed_path, crc, size
+
+
+def copy_member_data(src, dst, zinfo):
+    """Copy the <zinfo.compress_size> bytes of member data from <src> to <dst>."""
+    remaining = zinfo.compress_size
+    while remaining:
+        data = src.read(min(remaining, CHUNK_SIZE))
+        if not data:
+            raise EOFError(f'Unexpected end of the data of archive member {zinfo.filename}')
+        dst.write(data)
+        remaining -= len(data)
+
+
+def write_compressed_member(zf, zinfo, stream):
+    """Append a member whose data was already compressed (see `compress_file`)
+    to an archive open for writing.
+
+    zipfile has no public API for this, so this follows what `ZipFile.open`
+    does when writing a member, with the CRC and sizes known up front. It is
+    only done on the Python versions of RAW_MEMBER_PYTHON_VERSIONS. Elsewhere
+    only STORED members can be written, through `ZipFile.open`.
+
+    Args:
+        zf (:obj:zipfile.ZipFile): Archive open for writing (seekable).
+        zinfo (:obj:zipfile.ZipInfo): Member, with compress_type, CRC, file_size
+            and compress_size set.
+        stream (file): File-like object from which the <zinfo.compress_size>
+            bytes of member data are read.
+
+    """
+
+    if not RAW_MEMBERS:
+        if zinfo.compress_type != zipfile.ZIP_STORED:
+            raise RuntimeError(f'Writing compressed members is not supported on Python {sys.version_info[:2]}')
+        # ZipFile.open resets the sizes, which it computes itself
+        member = copy.copy(zinfo)
+        with zf.open(zinfo, 'w') as entry:
+            copy_member_data(stream, entry, member)
+        return
+
+    with zf._lock:
+        if zf._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        if zinfo.compress_type == zipfile.ZIP_LZMA:
+            # Compressed data includes an end-of-stream (EOS) marker
+            zinfo.flag_bits |= 0x02
+        zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT))
+        copy_member_data(stream, zf.fp, zinfo)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def copy_archive_file(archive_path, archive_file, zf, arcname):
+    """Copy a file of another archive into an archive open for writing, without
+    decompressing it.
+
+    Args:
+        archive_path (str): Path of the source archive.
+        archive_file (:obj:ArchiveFile): File of the source archive (see
+            `get_archive_files`).
+        zf (:obj:zipfile.ZipFile): Archive open for writing (seekable).
+        arcname (str): Name of the top-level folder in <zf>.
+
+    Returns:
+        dict: Manifest entry of the copied file (see `write_archive_manifest`).
+
+    """
+
+    member = archive_file.member
+    zinfo = zipfile.ZipInfo(os.path.join(arcname, archive_file.name + archive_file.codec.suffix), member.date_time)
+    zinfo.compress_type = member.compress_type
+    zinfo.external_attr = member.external_attr
+    zinfo.CRC, zinfo.file_size, zinfo.compress_size = member.CRC, member.file_size, member.compress_size
+    if not RAW_MEMBERS and member.compress_type != zipfile.ZIP_STORED:
+        # Decompressed and compressed again through the public API
+        with zipfile.ZipFile(archive_path) as source, source.open(member) as stream, zf.open(zinfo, 'w') as entry:
+            shutil.copyfileobj(stream, entry, CHUNK_SIZE)
+    else:
+        with open(archive_path, 'rb') as fp:
+            # The member data follows its local header, whose name and extra field
+            # lengths may differ from the central directory
+            fp.seek(member.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+            fp.seek(header[10] + header[11], os.SEEK_CUR)
+            write_compressed_member(zf, zinfo, fp)
+    return {'size': archive_file.size, 'sha384': archive_file.sha384, 'platform_hash': archive_file.platform_hash,
+            'codec': archive_file.codec.name, 'member': zinfo.filename}
+
+
+def create_archive(content_dir, arcname, zipfilepath=None, manifest=None, codec='auto', max_workers=1,
+                   copy_files=None):
     """Generae an archive from a given directory.
 
+    Files are compressed according to `get_archive_codec`, up to <max_workers>
+    at a time, into temporary files which are appended to the archive in order.
+    Files which do not shrink are STORED instead.
+
     Args:
         content_dir (str): Full path to directory containing archive content.
         arcname (str): Name for top-level folder in archive.
         zipfilepath (str): Desired path of output archive. If not provided the
                            content_dir basename will be used. Defaults to None.
+        manifest (dict, optional): File manifest to embed in the archive (see
+            `write_archive_manifest`), to which the codec and member of each
+            file are added. Defaults to None.
+        codec (str, optional): Codec of the files which are not already
+            compressed. Defaults to 'auto'.
+        max_workers (int, optional): Maximum number of files compressed
+            concurrently. Defaults to 1.
+        copy_files (list, optional): (archive path, ArchiveFile) tuples of
+            files of other archives to copy as is (see `copy_archive_file`),
+            which are added to the manifest. Defaults to None.
 
     Returns:
         str: Full path to created zip archive.
 
     """
 
-    import zipfile
-
     if not zipfilepath:
         zipfilepath = content_dir + '.zip'
-    with zipfile.ZipFile(zipfilepath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+    names = sorted(os.listdir(content_dir))
+    codecs = {fn: get_archive_codec(fn, codec) for fn in names}
+
+    def add(zf, fn, future):
+        path = os.path.join(content_dir, fn)
+        member = os.path.join(os.path.basename(arcname), fn)
+        file_codec = codecs[fn]
+        compressed_path, crc, size = future.result() if future else (None, None, None)
+        if compressed_path and os.path.getsize(compressed_path) < os.path.getsize(path):
+            if not RAW_MEMBERS and not file_codec.suffix:
+                # Native codec, compressed again by zipfile itself
+                zf.write(path, member, compress_type=file_codec.compress_type)
+            else:
+                zinfo = zipfile.ZipInfo.from_file(path, member + file_codec.suffix)
+                zinfo.compress_type = file_codec.compress_type
+                zinfo.CRC, zinfo.file_size, zinfo.compress_size = crc, size, os.path.getsize(compressed_path)
+                with open(compressed_path, 'rb') as stream:
+                    write_compressed_member(zf, zinfo, stream)
+        else:
+            file_codec = ARCHIVE_CODECS['store']
+            zf.write(path, member, compress_type=zipfile.ZIP_STORED)
+        if compressed_path:
+            os.remove(compressed_path)
+        if manifest is not None and fn in manifest:
+            manifest[fn].update(codec=file_codec.name, member=member + file_codec.suffix)
+
+    with zipfile.ZipFile(zipfilepath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf, \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
         zf.write(content_dir, arcname)
-        for fn in os.listdir(content_dir):
-            zf.write(os.path.join(content_dir, fn), os.path.join(os.path.basename(arcname), fn))
+        # Compression runs ahead of the (ordered) writes by at most <max_workers> files
+        pending = deque()
+        for fn in names:
+            pending.append((fn, executor.submit(compress_file, os.path.join(content_dir, fn), codecs[fn],
+                                                os.path.dirname(content_dir)) if codecs[fn].compressor else None))
+            while len(pending) > max_workers:
+                add(zf, *pending.popleft())
+        while pending:
+            add(zf, *pending.popleft())
+        for archive_path, archive_file in copy_files or []:
+            entry = copy_archive_file(archive_path, archive_file, zf, os.path.basename(arcname))
+            if manifest is not None:
+                manifest[archive_file.name] = entry
+        if manifest is not None:
+            write_archive_manifest(zf, manifest)
     return zipfilepath
 
 
@@ -43,6 +1907,9 @@ def extract_archive(zip_file_path, extract_location):
     """Extract zipfile to <zip_file_path> and return the path to the directory containing the files,
     which should be the zipfile name without the zip extension.
 
+    Members of codecs which zip does not support natively are decompressed to
+    their original file names.
+
     Args:
         zip_file_path (str): Full path to existing archive.
         extract_location (str): Full path of top-level destination for extraction.
@@ -56,10 +1923,23 @@ def extract_archive(zip_file_path, extract_location):
         log.warning('{} is not a Zip File!'.format(zip_file_path))
         return None
 
+    def extract(ZF, dest):
+        decoded = [f for f in get_archive_files(ZF) if f.codec.reader]
+        skip = {f.member.filename for f in decoded}
+        ZF.extractall(dest, [m for m in ZF.namelist() if m not in skip])
+        for archive_file in decoded:
+            path = os.path.normpath(os.path.join(dest, archive_file.member.filename[:-len(archive_file.codec.suffix)]))
+            if not path.startswith(os.path.normpath(dest) + os.sep):
+                log.warning(f'Skipping archive member outside of the extract directory: {archive_file.member.filename}')
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open_archive_file(ZF, archive_file) as stream, open(path, 'wb') as of:
+                shutil.copyfileobj(stream, of, CHUNK_SIZE)
+
     with zipfile.ZipFile(zip_file_path) as ZF:
         if '/' in ZF.namelist()[0]:
             extract_dest = os.path.join(extract_location, ZF.namelist()[0].split('/')[0])
-            ZF.extractall(extract_location)
+            extract(ZF, extract_location)
             return extract_dest
         else:
             extract_dest = os.path.join(extract_location, os.path.basename(zip_file_path).split('.zip')[0])
@@ -67,14 +1947,24 @@ def extract_archive(zip_file_path, extract_location):
                 log.debug('Creating extract directory: {}'.format(extract_dest))
                 os.mkdir(extract_dest)
             log.debug('Extracting {} archive to: {}'.format(zip_file_path, extract_dest))
-            ZF.extractall(extract_dest)
+            extract(ZF, extract_dest)
 
             return extract_dest
 
 
-def generate_project_template(gear_context, project, outname=None):
+@METRICS.phase('generate_project_template')
+def generate_project_template(gear_context, project, outname=None, baseline=None, template_format=None):
     """For a given project generate a dict with permissions and gear rules.
 
+    In the 'jsonl' format (see `TemplateStreamWriter`) each rule is written out
+    as soon as its gear info is known, and the template is returned as a
+    `TemplateStream` rather than held in memory.
+
+    When a <baseline> template (a previous export of the project) is given,
+    rules which did not change since (see `get_rule_digest`) are taken from it
+    along with their gear info, so only the gears of new or changed rules are
+    looked up.
+
     Args:
         gear_context (:obj:flywheel.gear_context.GearContext): Flywheel Gear
             Context
@@ -82,9 +1972,14 @@ def generate_project_template(gear_context, project, outname=None):
             has the existing permissions and gear rules.
         outname (str): Full path to output the json file contianing the template.
             If not provided we default to `/flywheel/v0/output/project_template.json`
+        baseline (dict, optional): Previous template of the project (dict or
+            TemplateStream). Defaults to None.
+        template_format (str, optional): 'json' (pretty printed) or 'jsonl'.
+            Defaults to config.template_format.
 
     Returns:
-        dict: Project template containing 'permissions', and 'rules':
+        dict: Project template containing 'permissions', and 'rules' (a
+            TemplateStream in the 'jsonl' format):
             {
               "permissions": [
                 {
@@ -125,34 +2020,126 @@ def generate_project_template(gear_context, project, outname=None):
     """
 
     fw = gear_context.client
+    template_format = template_format or gear_context.config.get('template_format', 'json')
 
     if not outname:
-        outname = os.path.join(gear_context.output_dir, 'project-settings_template_{}.json'.format(project.id))
+        outname = os.path.join(gear_context.output_dir, 'project-settings_template_{}.{}'.format(project.id, template_format))
 
     template = dict()
     template['rules'] = list()
 
     log.info(f'Generating template from source project: {project.group}/{project.label} [id={project.id}]')
 
-    rules = [ r.to_dict() for r in fw.get_project_rules(project.id) ]
+    rules = API.read(fw.get_project_rules, project.id)
 
     if gear_context.config.get('permissions'):
         template['permissions'] = [p.to_dict() for p in project.permissions ]
     else:
         template['permissions'] = list()
 
+    # Digest and gear info of the baseline rules, by id
+    baseline_rules = {r.get('id'): (get_rule_digest(r), r.get('gear'))
+                      for r in iter_template_items(baseline, 'rules') if r.get('id')} if baseline is not None else dict()
+    reused = 0
+    writer = TemplateStreamWriter(outname) if template_format == 'jsonl' else None
+    with writer or contextlib.nullcontext():
+        if writer:
+            for permission in template['permissions']:
+                writer.add('permissions', permission)
+        for rule in rules:
+            rule = rule.to_dict()
+            # Here we grab the gear info for easy lookup later on. Note that it will
+            # be removed.
+            digest, gear = baseline_rules.get(rule['id'], (None, None))
+            if gear and digest == get_rule_digest(rule):
+                rule['gear'] = gear
+                reused += 1
+            else:
+                rule['gear'] = GEAR_CACHE.get(fw, rule['gear_id'])['gear']
+            if writer:
+                writer.add('rules', rule)
+            else:
+                template['rules'].append(rule)
+    if baseline is not None:
+        log.info(f'{reused} of {len(rules)} gear rules are unchanged since the baseline template.')
 
-    for rule in rules:
-        # Here we grab the gear info for easy lookup later on. Note that it will
-        # be removed.
-        rule['gear'] = fw.get_gear(rule['gear_id']).gear.to_dict()
-        template['rules'].append(rule)
-
+    if writer:
+        return TemplateStream(outname)
     save_template(template, outname)
 
     return template
 
 
+def get_rule_digest(rule):
+    """Return the digest of a template rule, ignoring its gear info (which
+    follows from its gear_id)."""
+    return get_digest({k: v for k, v in rule.items() if k != 'gear'})
+
+
+def diff_items(baseline, items, key, digest):
+    """Compare two lists of items identified by <key> (callable).
+
+    Returns:
+        dict: {'added': [items], 'changed': [items], 'removed': [keys],
+            'unchanged': count}, where an item changed if its <digest>
+            (callable) differs from the baseline item with the same key.
+
+    """
+
+    baseline = OrderedDict((key(item), item) for item in baseline)
+    keys = set()
+    diff = {'added': list(), 'changed': list(), 'removed': list(), 'unchanged': 0}
+    for item in items:
+        keys.add(key(item))
+        if key(item) not in baseline:
+            diff['added'].append(item)
+        elif digest(baseline[key(item)]) != digest(item):
+            diff['changed'].append(item)
+        else:
+            diff['unchanged'] += 1
+    diff['removed'] = [k for k in baseline if k not in keys]
+    return diff
+
+
+def generate_template_patch(baseline, template, baseline_archive=None, fixed_input_archive=None):
+    """Describe what changed in a project's settings since a previous export.
+
+    Args:
+        baseline (dict): Previous template of the project (dict or TemplateStream).
+        template (dict): Current template of the project (dict or TemplateStream).
+        baseline_archive (str, optional): Fixed input archive of the previous
+            export. Defaults to None.
+        fixed_input_archive (str, optional): Current fixed input archive.
+            Defaults to None.
+
+    Returns:
+        dict: The template hashes, and the added, changed and removed rules
+            (by id), permissions (by user id) and fixed input files (by name,
+            compared by content hash).
+
+    """
+
+    def get_files(archive):
+        if not archive or not zipfile.is_zipfile(archive):
+            return list()
+        with zipfile.ZipFile(archive) as zf:
+            return get_archive_files(zf)
+
+    fixed_inputs = diff_items(get_files(baseline_archive), get_files(fixed_input_archive),
+                              lambda f: f.name, lambda f: f.sha384 or f.member.CRC)
+    return {
+        'version': 1,
+        'baseline': get_template_hash(baseline),
+        'template': get_template_hash(template),
+        'rules': diff_items(iter_template_items(baseline, 'rules'), iter_template_items(template, 'rules'),
+                            lambda r: r.get('id'), get_rule_digest),
+        'permissions': diff_items(iter_template_items(baseline, 'permissions'), iter_template_items(template, 'permissions'),
+                                  lambda p: p.get('id'), lambda p: sorted(p.get('role_ids') or [])),
+        'fixed_inputs': dict(fixed_inputs, added=[f.name for f in fixed_inputs['added']],
+                             changed=[f.name for f in fixed_inputs['changed']]),
+    }
+
+
 def save_template(template, outfilename):
     """Write project template to JSON file.
 
@@ -171,17 +2158,176 @@ def save_template(template, outfilename):
     return outfilename
 
 
-def download_fixed_inputs(gear_context, template, project_id):
+class TemplateStreamWriter(object):
+    """Write a project template in the line-delimited ('jsonl') format, one
+    record at a time.
+
+    The first line is a header record ({"record": "template", "version": ...}),
+    followed by one {"record": "permission"|"rule", "data": {...}} line per
+    permission and rule. Permissions must be added before rules. Lines are
+    flushed as they are added, so memory use does not grow with the template.
+
+    Args:
+        filename (str): Full path of the template file.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self.filename, 'w')
+        self._fp.write(json.dumps({'record': 'template', 'version': TEMPLATE_STREAM_VERSION}) + '\n')
+        return self
+
+    def __exit__(self, *exc):
+        self._fp.close()
+
+    def add(self, field, item):
+        """Write an item of the template <field> ('permissions' or 'rules')."""
+        self._fp.write(json.dumps({'record': TEMPLATE_RECORDS[field], 'data': item}, sort_keys=True) + '\n')
+        self._fp.flush()
+
+
+class TemplateStream(object):
+    """A project template in the line-delimited format (see
+    `TemplateStreamWriter`), read lazily.
+
+    Records are parsed one line at a time, each time the template is iterated
+    (see `iter_template_items`), so rules can be processed while later ones
+    have not been read yet.
+
+    Args:
+        filename (str): Full path of the template file.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._hash = None
+
+    @staticmethod
+    def is_stream(filename):
+        """Return True if <filename> starts with a template stream header."""
+        with open(filename) as tf:
+            try:
+                header = json.loads(tf.readline())
+            except ValueError:
+                return False
+        return isinstance(header, dict) and header.get('record') == 'template'
+
+    def iter(self, field):
+        """Iterate over the items of the template <field> ('permissions' or 'rules').
+
+        Raises:
+            ValueError: If the file is not a template stream, or has a line
+                which is not valid JSON.
+
+        """
+
+        with open(self.filename) as tf:
+            for lineno, line in enumerate(tf, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as err:
+                    raise ValueError(f'{self.filename} line {lineno}: {err}')
+                if lineno == 1:
+                    if not isinstance(record, dict) or record.get('record') != 'template' or \
+                            record.get('version') != TEMPLATE_STREAM_VERSION:
+                        raise ValueError(f'{self.filename} is not a version {TEMPLATE_STREAM_VERSION} template stream')
+                elif record.get('record') == TEMPLATE_RECORDS[field]:
+                    yield record.get('data')
+
+    @property
+    def hash(self):
+        """The `get_template_hash` of the same template as a dict, computed
+        without loading it."""
+        if self._hash is None:
+            digest = hashlib.sha256()
+            for i, field in enumerate(['permissions', 'rules']):
+                digest.update(('{' if i == 0 else '], ').encode() + json.dumps(field).encode() + b': [')
+                for j, item in enumerate(self.iter(field)):
+                    digest.update((', ' if j else '').encode() + json.dumps(item, sort_keys=True, default=str).encode())
+            digest.update(b']}')
+            self._hash = digest.hexdigest()
+        return self._hash
+
+
+def iter_template_items(template, field):
+    """Iterate over the items of the <field> ('permissions' or 'rules') of a
+    template, either a dict or a TemplateStream."""
+    if isinstance(template, TemplateStream):
+        return template.iter(field)
+    return iter(template.get(field) or [])
+
+
+def has_template_items(template, field):
+    """Return True if the template <field> ('permissions' or 'rules') is not empty."""
+    for _ in iter_template_items(template, field):
+        return True
+    return False
+
+
+def get_unique_fixed_inputs(template):
+    """Collect the fixed inputs referenced by the template's gear rules, without duplicates.
+
+    Fixed inputs are identified by (container id, file name). As all fixed inputs
+    end up as attachments of a single project, two different files sharing a
+    name cannot both be kept; the first one is used and a warning is logged.
+
+    Args:
+        template (dict): Project template dictionary, containing a list of project
+            "permissions" and a list of project "rules".
+
+    Returns:
+        list: Unique fixed input dicts, in the order they appear in the template.
+
+    """
+
+    unique = OrderedDict()
+    names = dict()
+    for rule in iter_template_items(template, 'rules'):
+        for fixed_input in rule.get('fixed_inputs') or []:
+            key = (fixed_input.get('id'), fixed_input.get('name'))
+            if key in unique:
+                continue
+            if key[1] in names:
+                log.warning(f'Fixed input {key[1]} from container {key[0]} has the same name as a fixed input '
+                            f'from container {names[key[1]]}. Only the file from {names[key[1]]} will be exported!')
+                continue
+            names[key[1]] = key[0]
+            unique[key] = fixed_input
+    return list(unique.values())
+
+
+@METRICS.phase('download_fixed_inputs')
+def download_fixed_inputs(gear_context, template, project_id, baseline_archive=None):
     """For each fixed input found in the templates gear rules, download the file
        and create an archive from those files within the outdir specified by the
        gear_context. The resulting archive can then be loaded to a new project.
 
+       Each file is downloaded once, no matter how many rules reference it. By
+       default (config.stream_fixed_inputs) downloads are streamed directly into
+       the archive. Otherwise files are downloaded concurrently
+       (config.max_workers) to a temporary directory, which is then archived.
+       Either way files are fetched as byte ranges (see `iter_file_download`)
+       and checked against their platform hash.
+
+       Files of the <baseline_archive> (a previous export) whose platform hash
+       and size match the current file are copied from it as is, instead of
+       being downloaded again.
+
     Args:
         gear_context (:obj:flywheel.gear_context.GearContext): Flywheel Gear
             Context
         template (dict): Project tempalte dictionary, containing a list of project
             "permissions" and a list of project "rules".
         project_id (string): Source project ID (used for naming the output archive.)
+        baseline_archive (str, optional): Full path to a previous fixed input
+            archive of the project. Defaults to None.
 
     Returns:
         str: Full path to generated fixed input archive.
@@ -190,35 +2336,312 @@ def download_fixed_inputs(gear_context, template, project_id):
 
     fw = gear_context.client
     outdir = gear_context.output_dir
+    max_workers = gear_context.config.get('max_workers', DEFAULT_MAX_WORKERS)
+    range_size, parallel = get_transfer_settings(gear_context.config)
+    codec, compress_workers = get_archive_settings(gear_context.config)
 
-    tdirpath = tempfile.mkdtemp()
-
-    # Create the archive directory, which will be zipped
-    content_dir = os.path.join(tdirpath, 'project-settings_fixed-inputs_{}'.format(project_id))
-    os.mkdir(content_dir)
-
-    downloaded = list() # List of files that are to be downloaded
+    arcname = 'project-settings_fixed-inputs_{}'.format(project_id)
+    archive_name = os.path.join(outdir, arcname + '.zip')
 
     log.info('Checking template for fixed inputs...')
-    for rule in template['rules']:
-        if rule.get('fixed_inputs'):
-            for fixed_input in rule.get('fixed_inputs'):
-                container = fw.get(fixed_input.get('id'))
-                fname = fixed_input.get('name')
-                container.download_file(fname, os.path.join(content_dir, fname))
-                downloaded.append(fname)
+    fixed_inputs = get_unique_fixed_inputs(template)
+    if not fixed_inputs:
+        log.info(f'Found {len(fixed_inputs)} fixed input files.')
+        return None
 
-    if downloaded:
-        archive_name = os.path.join(outdir, os.path.basename(content_dir) + '.zip')
-        log.info(f'Saved {len(downloaded)} fixed input files. Creating archive {archive_name}')
-        create_archive(content_dir, os.path.basename(content_dir), archive_name)
+    def log_transfer(fname, size, start):
+        elapsed = max(time.time() - start, 1e-6)
+        log.info(f' Downloaded {fname} ({format_size(size)} in {elapsed:.1f}s, {format_size(size / elapsed)}/s)')
+
+    def download(fixed_input):
+        fname = fixed_input.get('name')
+        container = containers[fixed_input.get('id')]
+        dest = os.path.join(content_dir, fname)
+        start = time.time()
+        file_entry = get_file_entry(container, fname)
+        sha384 = download_to_file(container, fname, dest, file_entry.size if file_entry else None,
+                                  file_entry.hash if file_entry else None, range_size, parallel)
+        METRICS.add_bytes('downloaded', os.path.getsize(dest))
+        log_transfer(fname, os.path.getsize(dest), start)
+        manifest[fname] = {'size': os.path.getsize(dest), 'sha384': sha384,
+                           'platform_hash': file_entry.hash if file_entry else None}
+        return os.path.getsize(dest)
+
+    # Each container is fetched once, regardless of how many files it holds
+    container_ids = list(OrderedDict.fromkeys(fi.get('id') for fi in fixed_inputs))
+    containers = dict(zip(container_ids, map_concurrently(lambda cid: API.read(fw.get, cid), container_ids, max_workers)))
+    start = time.time()
+
+    # Files which did not change since the baseline archive, by name
+    unchanged = OrderedDict()
+    if baseline_archive and zipfile.is_zipfile(baseline_archive):
+        with zipfile.ZipFile(baseline_archive) as zf:
+            baseline_files = {f.name: f for f in get_archive_files(zf)}
+        for fixed_input in fixed_inputs:
+            baseline_file = baseline_files.get(fixed_input.get('name'))
+            file_entry = get_file_entry(containers[fixed_input.get('id')], fixed_input.get('name'))
+            if baseline_file and file_entry and file_entry.hash and baseline_file.platform_hash == file_entry.hash \
+                    and baseline_file.size == file_entry.size:
+                unchanged[baseline_file.name] = baseline_file
+        log.info(f'{len(unchanged)} of {len(fixed_inputs)} fixed input files are unchanged since the baseline archive.')
+    elif baseline_archive:
+        log.warning('{} is not a Zip File! Downloading every fixed input file.'.format(baseline_archive))
+
+    if gear_context.config.get('stream_fixed_inputs', True):
+        log.info(f'Streaming {len(fixed_inputs)} fixed input files to archive {archive_name}')
+        total = 0
+        with StreamingArchiveWriter(archive_name, arcname, codec) as writer:
+            for fixed_input in fixed_inputs:
+                fname = fixed_input.get('name')
+                if fname in unchanged:
+                    writer.copy_file(baseline_archive, unchanged[fname])
+                    continue
+                container = containers[fixed_input.get('id')]
+                file_entry = get_file_entry(container, fname)
+                file_start = time.time()
+                size = writer.add_stream(fname, iter_file_download(container, fname, range_size,
+                                                                   file_entry.size if file_entry else None, parallel),
+                                         file_entry.size if file_entry else None,
+                                         file_entry.hash if file_entry else None)
+                verify_platform_hash(fname, writer.manifest[fname]['sha384'], writer.manifest[fname]['platform_hash'])
+                METRICS.add_bytes('downloaded', size)
+                log_transfer(fname, size, file_start)
+                total += size
     else:
-        log.info(f'Found {len(downloaded)} fixed input files.')
-        archive_name = None
+        tdirpath = tempfile.mkdtemp()
+        # Create the archive directory, which will be zipped
+        content_dir = os.path.join(tdirpath, arcname)
+        os.mkdir(content_dir)
+        manifest = dict()
+        changed = [fi for fi in fixed_inputs if fi.get('name') not in unchanged]
+        total = sum(map_concurrently(download, changed, max_workers))
+        log.info(f'Saved {len(changed)} fixed input files. Creating archive {archive_name}')
+        with METRICS.phase('create_archive'):
+            create_archive(content_dir, arcname, archive_name, manifest, codec, compress_workers,
+                           [(baseline_archive, f) for f in unchanged.values()])
+        shutil.rmtree(tdirpath)
+
+    elapsed = max(time.time() - start, 1e-6)
+    log.info(f'Exported {len(fixed_inputs)} fixed input files ({format_size(total)} downloaded in {elapsed:.1f}s, '
+             f'{format_size(total / elapsed)}/s, {len(unchanged)} copied from the baseline archive)')
+
+    return archive_name
+
+
+@METRICS.phase('export_bundle')
+def export_bundle(gear_context, export_project_paths):
+    """Export the settings of several projects into a single bundle, in which
+    fixed input files are stored once, keyed by content hash.
+
+    The bundle (BUNDLE_NAME.zip in the output directory) holds, under a
+    top-level BUNDLE_NAME folder:
+        - templates/<project_id>.json: the template of each project (see
+          `generate_project_template`), with an extra 'fixed_input_files' map
+          of fixed input file name to the sha384 of its content.
+        - blobs/<sha384>: each distinct fixed input file, stored once no
+          matter how many projects reference it (blobs/<sha384>.zst with the
+          zstd codec, see `get_archive_codec`).
+        - BUNDLE_INDEX_NAME: the exported projects (path, id, template member,
+          outcome) and blobs (size, archive member, file names).
+
+    Blobs are keyed by the platform file hash, so duplicates are skipped before
+    they are downloaded. Files without a sha384 platform hash are downloaded to
+    scratch space and hashed first. Templates are generated concurrently
+    (config.max_concurrent_projects), then the blobs are streamed into the
+    bundle one at a time.
+
+    Args:
+        gear_context (:obj:flywheel.gear_context.GearContext): Flywheel Gear
+            Context
+        export_project_paths (str): Comma (or newline) separated projects, see
+            `get_target_project_paths`.
+
+    Returns:
+        int: 0 if every project was exported, 1 otherwise.
+
+    """
+
+    fw = gear_context.client
+    range_size, parallel = get_transfer_settings(gear_context.config)
+    project_paths = get_target_project_paths(fw, export_project_paths, allow_groups=True)
+    log.info(f'Exporting settings of {len(project_paths)} projects to a bundle...')
+
+    tdirpath = tempfile.mkdtemp()
+    containers = dict()
+
+    def get_container(container_id):
+        return containers.get(container_id) or API.read(fw.get, container_id)
+
+    def export(project_path):
+        result = {'project_path': project_path, 'project_id': None, 'template': None, 'status': 'failed', 'error': None}
+        try:
+            project = API.read(fw.get_project, API.read(fw.lookup, project_path).id)
+            result['project_id'] = project.id
+            containers[project.id] = project
+            result['template_file'] = os.path.join(tdirpath, f'{project.id}.json')
+            template = generate_project_template(gear_context, project, result['template_file'], template_format='json')
+            result['fixed_inputs'] = list()
+            for fixed_input in get_unique_fixed_inputs(template):
+                container = get_container(fixed_input.get('id'))
+                file_entry = get_file_entry(container, fixed_input.get('name'))
+                if not file_entry:
+                    log.warning(f'Fixed input {fixed_input.get("name")} of {project_path} not found on '
+                                f'container {fixed_input.get("id")}!')
+                    result['error'] = f'Fixed input {fixed_input.get("name")} not found'
+                    continue
+                algorithm, hexdigest = parse_platform_hash(file_entry.hash)
+                result['fixed_inputs'].append({'name': file_entry.name, 'container': container, 'size': file_entry.size,
+                                               'platform_hash': file_entry.hash,
+                                               'sha384': hexdigest if algorithm == 'sha384' else None})
+            result['status'] = 'completed_with_errors' if result['error'] else 'success'
+        except flywheel.ApiException as err:
+            result['error'] = f'{err.status} -- {err.reason} -- {err.detail}'
+            log.error(f'API error while exporting {project_path}: {result["error"]}')
+        except Exception as err:
+            result['error'] = repr(err)
+            log.exception(f'Error while exporting {project_path}')
+        return result
+
+    report = map_concurrently(export, project_paths, gear_context.config.get('max_concurrent_projects', 2))
+    exported = [r for r in report if r['status'] != 'failed']
+
+    # Distinct blobs with a known hash, and files which have to be hashed first
+    blobs = OrderedDict()
+    unhashed = OrderedDict()
+    for result in exported:
+        for fixed_input in result['fixed_inputs']:
+            if fixed_input['sha384']:
+                blobs.setdefault(fixed_input['sha384'], fixed_input)
+            else:
+                unhashed.setdefault((fixed_input['container'].id, fixed_input['name']), fixed_input)
+    references = sum(len(r['fixed_inputs']) for r in exported)
+    log.info(f'{len(exported)} project templates reference {references} fixed input files, '
+             f'{len(blobs) + len(unhashed)} of which are distinct.')
+
+    bundle_name = os.path.join(gear_context.output_dir, BUNDLE_NAME + '.zip')
+    index = {'version': BUNDLE_VERSION, 'projects': list(), 'blobs': OrderedDict()}
+    failed_blobs = set()
+    start = time.time()
+    total = 0
+
+    with StreamingArchiveWriter(bundle_name, BUNDLE_NAME, get_archive_settings(gear_context.config)[0]) as writer:
+
+        def add_blob(sha384, fixed_input, chunks):
+            member = f'blobs/{sha384}'
+            size = writer.add_stream(member, chunks, fixed_input['size'], fixed_input['platform_hash'],
+                                     get_archive_codec(fixed_input['name'], writer.codec))
+            if writer.manifest[member]['sha384'] != sha384:
+                raise ValueError(f'Content of {fixed_input["name"]} does not match its hash {sha384}')
+            index['blobs'][sha384] = {'size': size, 'member': writer.manifest[member]['member'], 'names': list()}
+            METRICS.add_bytes('downloaded', size)
+            return size
+
+        for sha384, fixed_input in blobs.items():
+            try:
+                total += add_blob(sha384, fixed_input, iter_file_download(fixed_input['container'], fixed_input['name'],
+                                                                          range_size, fixed_input['size'], parallel))
+            except Exception as err:
+                log.error(f'Could not export fixed input {fixed_input["name"]}: {err!r}')
+                failed_blobs.add(sha384)
+
+        for fixed_input in unhashed.values():
+            scratch = os.path.join(tdirpath, 'blob')
+            try:
+                fixed_input['sha384'] = download_to_file(fixed_input['container'], fixed_input['name'], scratch,
+                                                         fixed_input['size'], None, range_size, parallel)
+                if fixed_input['sha384'] not in index['blobs']:
+                    with open(scratch, 'rb') as fp:
+                        total += add_blob(fixed_input['sha384'], fixed_input, iter(lambda: fp.read(CHUNK_SIZE), b''))
+            except Exception as err:
+                log.error(f'Could not export fixed input {fixed_input["name"]}: {err!r}')
+                fixed_input['sha384'] = None
+            finally:
+                if os.path.exists(scratch):
+                    os.remove(scratch)
+
+        for result in report:
+            if result['status'] != 'failed':
+                with open(result['template_file']) as tf:
+                    template = json.load(tf)
+                template['fixed_input_files'] = dict()
+                for fixed_input in result['fixed_inputs']:
+                    sha384 = fixed_input['sha384'] or unhashed.get((fixed_input['container'].id, fixed_input['name']),
+                                                                   dict()).get('sha384')
+                    if not sha384 or sha384 in failed_blobs:
+                        result['status'] = 'completed_with_errors'
+                        result['error'] = result['error'] or f'Fixed input {fixed_input["name"]} could not be exported'
+                        continue
+                    template['fixed_input_files'][fixed_input['name']] = sha384
+                    if fixed_input['name'] not in index['blobs'][sha384]['names']:
+                        index['blobs'][sha384]['names'].append(fixed_input['name'])
+                result['template'] = f'templates/{result["project_id"]}.json'
+                writer.add_stream(result['template'],
+                                  [json.dumps(template, sort_keys=True, indent=4, separators=(',', ': ')).encode()])
+            index['projects'].append({k: result[k] for k in ['project_path', 'project_id', 'template', 'status', 'error']})
+
+        writer.add_stream(BUNDLE_INDEX_NAME, [json.dumps(index, indent=4).encode()])
 
     shutil.rmtree(tdirpath)
 
-    return archive_name
+    elapsed = max(time.time() - start, 1e-6)
+    counts = OrderedDict((status, len([r for r in report if r['status'] == status]))
+                         for status in ['success', 'completed_with_errors', 'failed'])
+    log.info('Exported {} projects: {}. {} distinct fixed input files ({} in {:.1f}s, {}/s) saved to {}'.format(
+        len(report), ', '.join(f'{n} {status}' for status, n in counts.items()), len(index['blobs']),
+        format_size(total), elapsed, format_size(total / elapsed), bundle_name))
+
+    return 0 if counts['success'] == len(report) else 1
+
+
+@METRICS.phase('create_project')
+def get_or_create_project(fw, group_id, project_label, apply_to_existing_project=True, dry_run=False):
+    """Return the project <group_id>/<project_label>, creating it if it does not exist.
+
+    Args:
+        fw (:obj:flywheel.Client): Flywheel client.
+        group_id (str): Group ID.
+        project_label (str): Project label.
+        apply_to_existing_project (bool): Return the project if it already
+            exists. Defaults to True.
+        dry_run (bool): Do not create the project if it does not exist, but
+            return an unsaved project (without id) to plan against. Defaults to
+            False.
+
+    Returns:
+        :obj:flywheel.models.project.Project: Flywheel Project to which the
+            template permissions and rules will be applied, or None if the
+            project exists and <apply_to_existing_project> is False.
+
+    Raises:
+        flywheel.ApiException: If the project could not be created.
+
+    """
+
+    # Check for existing project
+    try:
+        project = API.read(fw.lookup, f'{group_id}/{project_label}')
+        if apply_to_existing_project and project:
+            log.info(f'Existing project {group_id}/{project_label} (id={project.id}) found! apply_to_existing_project flag is set... the template will be applied to this project!')
+            return API.read(fw.get_project, project.id)
+        else:
+            log.warning(f'Project {group_id}/{project_label} (id={project.id}) found! apply_to_existing_project flag is False, bailing out!')
+            return None
+    except flywheel.ApiException as err:
+        if err.status != 404:
+            raise
+
+    if dry_run:
+        log.info(f'Dry run: project {group_id}/{project_label} does not exist and would be created.')
+        return flywheel.Project(group=group_id, label=project_label, permissions=[], files=[])
+
+    log.info(f'Creating new project: group={group_id}, label={project_label}')
+    project_id = API.write(fw.add_project, {'group': group_id, "label": project_label})
+    API.invalidate('lookup', f'{group_id}/{project_label}')
+    API.invalidate('get_group_projects', group_id)
+    project = API.read(fw.get_project, project_id)
+    log.info(f'Done. Created new project: group={group_id}, label={project_label}, id={project.id}')
+
+    return project
 
 
 def create_project(gear_context):
@@ -232,7 +2655,8 @@ def create_project(gear_context):
 
     Returns:
         :obj:flywheel.models.project.Project: Flywheel Project to which the
-            template permissions and rules will be applied.
+            template permissions and rules will be applied, or None if it
+            could not be created (or used).
 
     """
 
@@ -243,63 +2667,717 @@ def create_project(gear_context):
     group_id = clone_project_path[0]
     project_label = clone_project_path[1]
 
-    # Check for existing project
     try:
-        project = fw.lookup(f'{group_id}/{project_label}')
-        if gear_context.config.get('apply_to_existing_project') and project:
-            log.info(f'Existing project {group_id}/{project_label} (id={project.id}) found! apply_to_existing_project flag is set... the template will be applied to this project!')
-            return fw.get_project(project.id)
-        else:
-            log.warning(f'Project {group_id}/{project_label} (id={project.id}) found! apply_to_existing_project flag is False, bailing out!')
-            os._exit(1)
-    except:
-        pass
+        return get_or_create_project(fw, group_id, project_label,
+                                     gear_context.config.get('apply_to_existing_project'),
+                                     gear_context.config.get('dry_run', False))
+    except flywheel.ApiException as err:
+        log.error(f'API error during project creation: {err.status} -- {err.reason} -- {err.detail}')
+        return None
 
-    log.info(f'Creating new project: group={group_id}, label={project_label}')
+
+def get_target_project_paths(fw, clone_project_paths, allow_groups=False, exclude=None):
+    """Expand the comma (or newline) separated <group>/<project> entries of
+    config.clone_project_paths into a list of project paths.
+
+    The project part of an entry may be a shell-style pattern (e.g.
+    'my-group/study-*'), which is matched against the labels of the group's
+    existing projects. If <allow_groups> is set, an entry without a project
+    part (e.g. 'my-group') stands for every project of the group. Other entries
+    are returned as is, and will be created if they do not exist.
+
+    Args:
+        fw (:obj:flywheel.Client): Flywheel client.
+        clone_project_paths (str): Project paths and/or patterns.
+        allow_groups (bool, optional): Accept entries without a project part.
+            Defaults to False.
+        exclude (str, optional): <group>/<project> path left out of pattern
+            matches (e.g. the source project). Defaults to None.
+
+    Returns:
+        list: Unique <group>/<project> paths, in the order given.
+
+    Raises:
+        ValueError: If entries without a project part are given, and
+            <allow_groups> is not set.
+
+    """
+
+    entries = [entry.strip() for entry in re.split(r'[,\n]', clone_project_paths) if entry.strip()]
+    invalid = [entry for entry in entries if not entry.partition('/')[2]]
+    if invalid and not allow_groups:
+        raise ValueError('Project paths must be <group_id>/<project_name>, got: {}'.format(', '.join(invalid)))
+
+    paths = OrderedDict()
+    group_projects = dict()
+    for entry in entries:
+        group_id, _, label_pattern = entry.partition('/')
+        label_pattern = label_pattern or '*'
+        if not any(c in label_pattern for c in '*?['):
+            paths[entry] = None
+            continue
+        if group_id not in group_projects:
+            group_projects[group_id] = sorted(p.label for p in API.read(fw.get_group_projects, group_id))
+        matches = fnmatch.filter(group_projects[group_id], label_pattern)
+        if not matches:
+            log.warning(f'No project in group {group_id} matches {label_pattern}')
+        for label in matches:
+            if f'{group_id}/{label}' == exclude:
+                log.info(f'Leaving out {exclude}, the source project, from the projects matching {entry}')
+                continue
+            paths[f'{group_id}/{label}'] = None
+    return list(paths)
+
+
+def apply_template_to_projects(gear_context, template, fixed_input_archive=None, source_project=None):
+    """Apply the template to every project of config.clone_project_paths.
+
+    Projects are processed concurrently (config.max_concurrent_projects). They
+    share the client, the gear and user caches and the fixed input archive. A
+    failure on one project is recorded and does not stop the others. A report
+    with the outcome for every project is written to the output directory.
+
+    Args:
+        gear_context (:obj:flywheel.gear_context.GearContext): Flywheel Gear
+            Context
+        template (dict): Project tempalte dictionary, containing a list of project
+            "permissions" and a list of project "rules".
+        fixed_input_archive (str, optional): Path to archive containing gear
+            rule fixed inputs. Defaults to None.
+        source_project (:obj: flywheel.models.project.Project, optional): Source
+            project, which is never matched by the patterns of
+            config.clone_project_paths. Defaults to None.
+
+    Returns:
+        int: 0 if the template was applied to every project, 1 otherwise.
+
+    """
+
+    fw = gear_context.client
+    exclude = f'{source_project.group}/{source_project.label}' if source_project else None
     try:
-        project_id = fw.add_project({'group': group_id, "label": project_label})
-        project = fw.get_project(project_id)
-        log.info(f'Done. Created new project: group={group_id}, label={project_label}, id={project.id}')
+        project_paths = get_target_project_paths(fw, gear_context.config.get('clone_project_paths'), exclude=exclude)
+    except ValueError as err:
+        log.error(f'Invalid clone_project_paths, the template was not applied: {err}')
+        return 1
+    log.info(f'Applying template to {len(project_paths)} projects...')
+
+    def apply(project_path):
+        result = {'project_path': project_path, 'project_id': None, 'status': 'failed', 'error': None}
+        start = time.time()
+        try:
+            group_id, project_label = project_path.split('/', 1)
+            project = get_or_create_project(fw, group_id, project_label,
+                                            gear_context.config.get('apply_to_existing_project'),
+                                            gear_context.config.get('dry_run', False))
+            if project:
+                result['project_id'] = project.id
+                status = apply_template_to_project(gear_context, project, template, fixed_input_archive)
+                result['status'] = 'success' if status == 0 else 'completed_with_errors'
+            else:
+                result['status'] = 'skipped'
+                result['error'] = 'Project exists and apply_to_existing_project is False'
+        except flywheel.ApiException as err:
+            result['error'] = f'{err.status} -- {err.reason} -- {err.detail}'
+            log.error(f'API error while applying template to {project_path}: {result["error"]}')
+        except Exception as err:
+            result['error'] = repr(err)
+            log.exception(f'Error while applying template to {project_path}')
+        result['elapsed'] = round(time.time() - start, 3)
+        return result
 
-    except flywheel.ApiException as err:
-        log.error(f'API error during project creation: {err.status} -- {err.reason} -- {err.detail}')
-        os._exit(1)
+    report = map_concurrently(apply, project_paths, gear_context.config.get('max_concurrent_projects', 2))
 
-    return project
+    report_name = os.path.join(gear_context.output_dir, 'project-settings_apply-report.json')
+    with open(report_name, 'w') as rf:
+        json.dump(report, rf, indent=4)
+
+    counts = OrderedDict((status, len([r for r in report if r['status'] == status]))
+                         for status in ['success', 'completed_with_errors', 'skipped', 'failed'])
+    log.info('Applied template to {} projects: {}. Report saved to {}'.format(
+        len(report), ', '.join(f'{n} {status}' for status, n in counts.items()), report_name))
+
+    return 0 if counts['success'] == len(report) else 1
+
+
+def get_archive_members(zf):
+    """Return the ZipInfo of every file (i.e. not directory) member of an open archive."""
+    return [member for member in zf.infolist() if not member.filename.endswith('/')]
 
 
-def upload_fixed_inputs(fixed_input_archive, project):
-    """Unpack the fixed inputs archive and upload to the clone project.
+@METRICS.phase('upload_fixed_inputs')
+def plan_fixed_inputs(plan, fixed_input_archive, project, max_workers=DEFAULT_MAX_WORKERS, incremental=True):
+    """Plan uploading the files of the fixed inputs archive to the clone project.
+
+    Files are streamed straight from the archive members (no extraction to
+    disk, members of every codec are decompressed on the fly, see
+    `get_archive_files`). Each upload is an operation of its own, so that the
+    rules using a file only wait for that file.
+
+    When <incremental> is set, files already attached to the project with the
+    same size and content hash are not uploaded again. Hashes are taken from the
+    archive manifest when present, and only computed from the archive members
+    otherwise (and only for files whose name and size match).
+
+    The content of each upload is hashed as it is sent, and checked against the
+    archive manifest as soon as the upload completes. Once every upload has
+    completed, a verification operation checks the uploaded files against the
+    size and platform hash of the project files.
+
+    Uploads are recorded in the JOURNAL as soon as they are checked against the
+    manifest (or verified against the project, for archives without one), so
+    that files uploaded by a previous (failed or killed) run are skipped
+    without listing or hashing them again.
 
     Args:
+        plan (:obj:Plan): Plan to which the operations are added.
         fixed_input_archive (str): Full path to `fixed_input_archive`.
         project (:obj: flywheel.models.project.Project): Flywheel Project to which
             the fixed_inputs will be uploaded.
+        max_workers (int): Maximum number of files hashed concurrently while
+            planning. Defaults to DEFAULT_MAX_WORKERS.
+        incremental (bool): Skip files which are already attached to the project.
+            Defaults to True.
 
     Returns:
-        The return value. True for success, False otherwise.
+        dict: Id of the upload operation of each file name, or None if the
+            archive is not a zip file.
 
     """
 
-    tdirpath = tempfile.mkdtemp()
+    if not zipfile.is_zipfile(fixed_input_archive):
+        log.warning('{} is not a Zip File!'.format(fixed_input_archive))
+        return None
+
+    with zipfile.ZipFile(fixed_input_archive) as zf:
+        files = get_archive_files(zf)
+
+    def get_identity(archive_file):
+        return {'size': archive_file.size, 'crc': archive_file.member.CRC, 'sha384': archive_file.sha384}
+
+    step_digest = get_digest(sorted([f.name, get_identity(f)] for f in files))
+    if JOURNAL.is_done(project.id, 'step', 'fixed_inputs', digest=step_digest):
+        log.info('All fixed input files were uploaded by a previous run (see journal). Skipping.')
+        return dict()
+    journaled = [f for f in files if JOURNAL.is_done(project.id, 'upload', f.name, **get_identity(f))]
+    if journaled:
+        log.info(f'{len(journaled)} fixed input files were uploaded by a previous run (see journal). Skipping them.')
+        files = [f for f in files if f not in journaled]
+
+    # Single fetch of the project's current attachments
+    existing = dict()
+    if incremental and files and project.id:
+        existing = {f.name: f for f in API.call(project.reload).files or []}
+
+    def is_synced(archive_file):
+        # Each worker reads through its own handle, zipfile handles are not thread safe
+        file_entry = existing.get(archive_file.name)
+        if not file_entry or file_entry.size != archive_file.size:
+            return False
+        algorithm, hexdigest = parse_platform_hash(file_entry.hash)
+        if algorithm != 'sha384':
+            return False
+        if archive_file.sha384:
+            return archive_file.sha384 == hexdigest
+        with zipfile.ZipFile(fixed_input_archive) as zf, open_archive_file(zf, archive_file) as stream:
+            return hash_stream(stream) == hexdigest
+
+    if existing:
+        synced = map_concurrently(is_synced, files, max_workers)
+        for archive_file in [f for f, is_up_to_date in zip(files, synced) if is_up_to_date]:
+            log.info(f'Fixed input file {archive_file.name} is already up to date on the project. Skipping.')
+            JOURNAL.record(project.id, 'upload', archive_file.name, **get_identity(archive_file))
+        files = [f for f, is_up_to_date in zip(files, synced) if not is_up_to_date]
+
+    uploaded = dict()  # ArchiveFile -> sha384 of the uploaded content
+
+    def upload(archive_file):
+        log.info(f'Uploading fixed input file: {archive_file.name} ({format_size(archive_file.size)})')
+        start = time.time()
+        sha384 = uploaded[archive_file] = API.transfer(upload_file, archive_file)
+        METRICS.add_bytes('uploaded', archive_file.size)
+        elapsed = max(time.time() - start, 1e-6)
+        log.info(f' Uploaded {archive_file.name} ({format_size(archive_file.size)} in {elapsed:.1f}s, '
+                 f'{format_size(archive_file.size / elapsed)}/s)')
+        if archive_file.sha384:
+            if sha384 != archive_file.sha384:
+                raise ValueError(f'Checksum of {archive_file.name} does not match the archive manifest')
+            JOURNAL.record(project.id, 'upload', archive_file.name, **get_identity(archive_file))
+
+    def upload_file(archive_file):
+        # The member is re-opened on every attempt, as a failed upload consumes the stream
+        with zipfile.ZipFile(fixed_input_archive) as zf, open_archive_file(zf, archive_file) as stream:
+            reader = HashingReader(stream, archive_file.size)
+            project.upload_file(flywheel.FileSpec(archive_file.name, reader))
+            return reader.digest.hexdigest()
+
+    def verify():
+        # Single fetch of the project's attachments for all uploads
+        API.invalidate('get_project', project.id)
+        API.invalidate('get', project.id)
+        project_files = {f.name: f for f in API.call(project.reload).files or []} if uploaded else dict()
+        failed = len(files) - len(uploaded)
+        for archive_file, sha384 in uploaded.items():
+            fname = archive_file.name
+            file_entry = project_files.get(fname)
+            try:
+                if not file_entry or file_entry.size != archive_file.size:
+                    raise ValueError(f'Uploaded {fname} is missing or has the wrong size on the project')
+                if archive_file.sha384 not in (None, sha384):
+                    raise ValueError(f'Checksum of {fname} does not match the archive manifest')
+                verify_platform_hash(fname, sha384, file_entry.hash)
+                if not archive_file.sha384:
+                    JOURNAL.record(project.id, 'upload', fname, **get_identity(archive_file))
+            except ValueError as err:
+                log.error(f'Upload verification failed: {err}')
+                failed += 1
+                if JOURNAL.is_done(project.id, 'upload', fname, **get_identity(archive_file)):
+                    # Journaled when it completed, a rerun must upload it again
+                    JOURNAL.record(project.id, 'upload', fname, failed=True)
+        if failed:
+            raise ValueError(f'{failed} fixed input files failed to upload or verify')
+
+    upload_ops = OrderedDict((f.name, plan.add('upload', f.name, functools.partial(upload, f), transfer=True,
+                                               size=f.size, sha384=f.sha384)) for f in files)
+    verify_ops = [plan.add('verify', 'fixed_inputs', verify, upload_ops.values(), always=True,
+                           files=list(upload_ops))] if upload_ops else []
+    plan.add('step', 'fixed_inputs', functools.partial(JOURNAL.record, project.id, 'step', 'fixed_inputs', digest=step_digest),
+             verify_ops, digest=step_digest)
+    return upload_ops
+
+
+def get_existing_users(fw, user_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """Return the subset of <user_ids> which are valid users on the instance.
+
+    Each user is looked up individually (concurrently), so the cost scales
+    with the number of <user_ids> rather than with the number of users on the
+    instance. Lookups go through the read cache, so each user is only looked
+    up once per run, even by concurrent callers.
 
-    fixed_input_dir = extract_archive(fixed_input_archive, tdirpath)
+    Args:
+        fw (:obj:flywheel.Client): Flywheel client.
+        user_ids (iterable): User IDs to check.
+        max_workers (int): Maximum number of concurrent lookups. Defaults to
+            DEFAULT_MAX_WORKERS.
 
-    # Get file paths from the input dir
-    fixed_inputs = glob2.glob(fixed_input_dir + '/*', recursive=True)
+    Returns:
+        set: IDs of the users which exist.
 
-    # Upload each of the fixed inputs to the clone project.
-    for fixed_input in fixed_inputs:
-        log.info(f'Uploading fixed input file: {os.path.basename(fixed_input)}')
-        project.upload_file(fixed_input)
+    """
 
-    log.debug(f'Deleting {fixed_input_dir}')
+    def exists(user_id):
+        try:
+            API.read(fw.get_user, user_id)
+            return True
+        except flywheel.ApiException as err:
+            if err.status == 404:
+                return False
+            raise
 
-    shutil.rmtree(tdirpath)
+    user_ids = list(OrderedDict.fromkeys(user_ids))
+    return {u for u, found in zip(user_ids, map_concurrently(exists, user_ids, max_workers)) if found}
 
-    return True
 
+@METRICS.phase('permissions')
+def plan_permissions(plan, fw, project, permissions, max_workers=DEFAULT_MAX_WORKERS):
+    """Plan adding <permissions> to <project>, skipping users which already have a
+    permission on the project or do not exist on this instance.
 
+    Args:
+        plan (:obj:Plan): Plan to which the operations are added.
+        fw (:obj:flywheel.Client): Flywheel client.
+        project (:obj: flywheel.models.project.Project): Flywheel Project to which
+            the permissions will be added.
+        permissions (list): Permissions (RolesRoleAssignment or dicts with 'id'
+            and 'role_ids').
+        max_workers (int): Maximum number of concurrent user lookups. Defaults
+            to DEFAULT_MAX_WORKERS.
+
+    Returns:
+        list: Ids of the planned operations, which are independent of each other.
+
+    """
+
+    project_users = {x.id for x in project.permissions or []}
+    to_add = OrderedDict()
+    for permission in permissions:
+        log.debug(permission)
+        if not isinstance(permission, flywheel.models.roles_role_assignment.RolesRoleAssignment):
+            permission = flywheel.RolesRoleAssignment(permission['id'], permission['role_ids'])
+        if permission.id in project_users or permission.id in to_add:
+            log.warning(' {} will not be added to {}. The user is already in the project.'.format(permission.id, project.label))
+        elif JOURNAL.is_done(project.id, 'permission', permission.id, role_ids=list(permission.role_ids or [])):
+            log.info(' {} was already added to {} by a previous run (see journal).'.format(permission.id, project.label))
+        else:
+            to_add[permission.id] = permission
+
+    valid_users = get_existing_users(fw, to_add, max_workers)
+    for user_id in to_add:
+        if user_id not in valid_users:
+            log.warning(' {} will not be added to {}. The user is not a valid user.'.format(user_id, project.label))
+
+    def add(permission):
+        log.info(' Adding {} to {}'.format(permission.id, project.label))
+        API.write(project.add_permission, permission)
+        API.invalidate('get_project', project.id)
+        API.invalidate('get', project.id)
+        JOURNAL.record(project.id, 'permission', permission.id, role_ids=list(permission.role_ids or []))
+
+    return [plan.add('permission', user_id, functools.partial(add, permission), role_ids=list(permission.role_ids or []))
+            for user_id, permission in to_add.items() if user_id in valid_users]
+
+
+RULE_SIGNATURE_FIELDS = ('gear_id', 'name', 'config', 'fixed_inputs', 'auto_update', 'any', 'all', '_not', 'disabled')
+
+
+def get_rule_signature(rule):
+    """Return a canonical string of the gear rule fields which are set from a
+    template, so that a template rule can be compared with an existing rule.
+
+    Args:
+        rule (:obj:flywheel.models.rule.Rule): Gear rule (or rule dict).
+
+    Returns:
+        str: Rule signature.
+
+    """
+
+    data = rule.to_dict() if hasattr(rule, 'to_dict') else rule
+    signature = dict()
+    for field in RULE_SIGNATURE_FIELDS:
+        value = data.get(field)
+        if field == 'fixed_inputs':
+            value = [{k: v for k, v in fi.items() if v is not None} for fi in value or []]
+        elif field in ('any', 'all', '_not'):
+            value = [dict(condition, regex=bool(condition.get('regex'))) for condition in value or []]
+        elif field in ('auto_update', 'disabled'):
+            value = bool(value)
+        elif field == 'config':
+            value = value or dict()
+        signature[field] = value
+    return json.dumps(signature, sort_keys=True, default=str)
+
+
+def diff_project_rules(gear_rules, existing_rules, rule_action):
+    """Compute the changes needed to apply the template <gear_rules> to a project
+    which already has <existing_rules>.
+
+    Existing rules are matched by name. Depending on <rule_action>:
+        REPLACE: a matching rule identical to the template rule is kept as is,
+            otherwise the first matching rule is updated. Any other rule with
+            the same name is deleted.
+        SKIP: matching rules are left untouched.
+        APPEND: the template rule is added, unless an identical rule exists.
+
+    Args:
+        gear_rules (list): Template rules (:obj:flywheel.models.rule.Rule).
+        existing_rules (list): Rules currently on the project.
+        rule_action (str): One of 'REPLACE', 'SKIP' or 'APPEND'.
+
+    Returns:
+        dict: Lists of rules keyed by change: 'unchanged', 'add', 'delete', and
+            'update' (list of (existing_rule, template_rule) tuples).
+
+    """
+
+    existing_by_name = OrderedDict()
+    for rule in existing_rules:
+        existing_by_name.setdefault(rule.name, list()).append(rule)
+
+    diff = {'unchanged': list(), 'add': list(), 'update': list(), 'delete': list()}
+    matched_names = set()
+    for gear_rule in gear_rules:
+        name = gear_rule.get('name')
+        matching = existing_by_name.pop(name, list())
+        if not matching:
+            if rule_action == "SKIP" and name in matched_names:
+                diff['unchanged'].append(gear_rule)
+            else:
+                diff['add'].append(gear_rule)
+            continue
+
+        matched_names.add(name)
+        log.warning('A matching rule for \'{}\' was already found on this project.'.format(name))
+        signature = get_rule_signature(gear_rule)
+        identical = [r for r in matching if get_rule_signature(r) == signature]
+        if rule_action == "REPLACE":
+            keep = identical[0] if identical else matching[0]
+            if identical:
+                log.info('REPLACE action was configured. The matching rule is identical, nothing to do.')
+                diff['unchanged'].append(gear_rule)
+            else:
+                log.info('REPLACE action was configured. Updating the matching rule.')
+                diff['update'].append((keep, gear_rule))
+            diff['delete'].extend(r for r in matching if r is not keep)
+        elif rule_action == "SKIP":
+            log.info('SKIP action was configured. Not adding rule from template.')
+            diff['unchanged'].append(gear_rule)
+        elif identical:
+            log.info('APPEND action was configured, but an identical rule exists. Not adding rule from template.')
+            diff['unchanged'].append(gear_rule)
+        else:
+            log.warning('APPEND action was configured. Template rule will be added - duplicates will exist.')
+            diff['add'].append(gear_rule)
+
+    return diff
+
+
+def plan_rule_diff(plan, fw, project, diff, upload_ops=None):
+    """Plan the API calls for the changes computed by `diff_project_rules`.
+
+    Each call touches a different rule, so they are independent of each other.
+    A rule which is added or updated only waits for the upload of the fixed
+    input files it references (<upload_ops>), not for every upload. Completed
+    changes are recorded in the JOURNAL. A rerun does not need them to resume:
+    the diff against the rules then on the project leaves out the changes
+    already made.
+
+    Args:
+        plan (:obj:Plan): Plan to which the operations are added.
+        fw (:obj:flywheel.Client): Flywheel client.
+        project (:obj: flywheel.models.project.Project): Flywheel Project to which
+            the rules are applied.
+        diff (dict): Rule changes, as returned by `diff_project_rules`.
+        upload_ops (dict, optional): Id of the upload operation of each fixed
+            input file name, as returned by `plan_fixed_inputs`. Defaults to None.
+
+    Returns:
+        list: Ids of the planned operations.
+
+    """
+
+    upload_ops = upload_ops or dict()
+
+    def delete(rule):
+        log.info('Deleting duplicate "{}" rule (id={}) from "{}" project'.format(rule.name, rule.id, project.label))
+        API.write(fw.remove_project_rule, project.id, rule.id)
+        API.invalidate('get_project_rules', project.id)
+        JOURNAL.record(project.id, 'rule_delete', rule.id, name=rule.name)
+
+    def update(existing_rule, gear_rule):
+        log.info('Updating "{}" rule (id={}) on "{} (id={})" project'.format(gear_rule['name'], existing_rule.id, project.label, project.id))
+        body = gear_rule.to_dict()
+        body = flywheel.models.rule.Rule(**{k: body[k] for k in RULE_SIGNATURE_FIELDS})
+        API.call(fw.modify_project_rule, project.id, existing_rule.id, body)
+        API.invalidate('get_project_rules', project.id)
+        JOURNAL.record(project.id, 'rule_update', existing_rule.id, name=gear_rule['name'],
+                       digest=get_digest(get_rule_signature(gear_rule)))
+
+    def add(gear_rule):
+        log.info('Adding "{}" rule to "{} (id={})" project'.format(gear_rule['name'], project.label, project.id))
+        API.write(fw.add_project_rule, project.id, gear_rule)
+        API.invalidate('get_project_rules', project.id)
+        digest = get_digest(get_rule_signature(gear_rule))
+        JOURNAL.record(project.id, 'rule_add', f'{gear_rule["name"]}/{digest}', name=gear_rule['name'], digest=digest)
+
+    def get_uploads(gear_rule):
+        names = [fi.get('name') for fi in gear_rule.get('fixed_inputs') or []]
+        return [upload_ops[name] for name in OrderedDict.fromkeys(names) if name in upload_ops]
+
+    log.info(f'Rule changes: {len(diff["unchanged"])} unchanged, {len(diff["update"])} to update, '
+             f'{len(diff["add"])} to add, {len(diff["delete"])} to delete')
+    operations = [plan.add('rule_delete', rule.name, functools.partial(delete, rule), rule_id=rule.id)
+                  for rule in diff['delete']]
+    operations += [plan.add('rule_update', gear_rule['name'], functools.partial(update, existing_rule, gear_rule),
+                            get_uploads(gear_rule), rule_id=existing_rule.id)
+                   for existing_rule, gear_rule in diff['update']]
+    operations += [plan.add('rule_add', gear_rule['name'], functools.partial(add, gear_rule), get_uploads(gear_rule))
+                   for gear_rule in diff['add']]
+    return operations
+
+
+def get_template_hash(template):
+    """Return the sha256 of the canonical JSON form of a template (dict or TemplateStream)."""
+    if isinstance(template, TemplateStream):
+        return template.hash
+    return hashlib.sha256(json.dumps(template, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def validate_template(template):
+    """Check the structure of a project template.
+
+    Args:
+        template (dict): Project template dictionary.
+
+    Raises:
+        ValueError: Listing every problem found in the template.
+
+    """
+
+    def check_conditions(where, conditions):
+        for condition in conditions or []:
+            if not isinstance(condition, dict) or not condition.get('type'):
+                problems.append(f'{where}: condition without a type: {condition!r}')
+
+    problems = list()
+    if not isinstance(template, (dict, TemplateStream)):
+        raise ValueError('Template must be a JSON object')
+    for field in ('permissions', 'rules'):
+        if isinstance(template, dict) and not isinstance(template.get(field) or [], list):
+            problems.append(f'"{field}" must be a list')
+    if problems:
+        raise ValueError('Invalid template: ' + '; '.join(problems))
+
+    for i, permission in enumerate(iter_template_items(template, 'permissions')):
+        if not isinstance(permission, dict) or not isinstance(permission.get('id'), str) or \
+                not isinstance(permission.get('role_ids'), list):
+            problems.append(f'permission {i}: expected {{"id": <user_id>, "role_ids": [...]}}')
+    for i, rule in enumerate(iter_template_items(template, 'rules')):
+        where = f'rule {i} ({rule.get("name") if isinstance(rule, dict) else rule!r})'
+        if not isinstance(rule, dict):
+            problems.append(f'{where}: must be an object')
+            continue
+        for field in ('name', 'gear_id'):
+            if not isinstance(rule.get(field), str) or not rule.get(field):
+                problems.append(f'{where}: "{field}" is required')
+        if not isinstance(rule.get('config') or dict(), dict):
+            problems.append(f'{where}: "config" must be an object')
+        for field in ('fixed_inputs', 'all', 'any', '_not'):
+            if not isinstance(rule.get(field) or [], list):
+                problems.append(f'{where}: "{field}" must be a list')
+        for fixed_input in rule.get('fixed_inputs') or []:
+            if not isinstance(fixed_input, dict) or not fixed_input.get('name') or not fixed_input.get('input'):
+                problems.append(f'{where}: fixed input without a name or input: {fixed_input!r}')
+        for field in ('all', 'any', '_not'):
+            if isinstance(rule.get(field) or [], list):
+                check_conditions(f'{where} "{field}"', rule.get(field))
+
+    if problems:
+        raise ValueError('Invalid template: ' + '; '.join(problems))
+
+
+def normalize_template_rule(rule, gear_id):
+    """Return the fields of a template rule to apply, in the form the API expects.
+
+    Fixed inputs are moved to the target project (their 'id' is set when the
+    rule is applied), empty 'base' and 'found' fields are dropped, and unset
+    condition regex flags are set to False.
+
+    Args:
+        rule (dict): Template rule.
+        gear_id (str): Id of the rule's gear on this instance.
+
+    Returns:
+        dict: Rule fields (RULE_SIGNATURE_FIELDS).
+
+    """
+
+    fixed_inputs = list()
+    for fixed_input in rule.get('fixed_inputs') or []:
+        fixed_input = {k: v for k, v in fixed_input.items() if k not in ('base', 'found') or v}
+        fixed_input['type'] = 'project'
+        fixed_input['id'] = None
+        fixed_inputs.append(fixed_input)
+
+    normalized = {'gear_id': gear_id, 'name': rule['name'], 'config': rule.get('config') or dict(),
+                  'fixed_inputs': fixed_inputs, 'auto_update': rule.get('auto_update'),
+                  'disabled': rule.get('disabled')}
+    for field in ('any', 'all', '_not'):
+        normalized[field] = [dict(condition, regex=condition.get('regex') or False)
+                             for condition in rule.get(field) or []]
+    return normalized
+
+
+class TemplateCompiler(object):
+    """Compile project templates into the form in which their gear rules are
+    applied, once per template and instance.
+
+    Compiling validates the template, resolves its gears on the instance and
+    normalizes its rules. Compiled templates are kept for the
+    run, keyed by template hash and instance host, so applying one template to
+    many projects compiles it once. They can be saved to, and loaded from, a
+    JSON file so that subsequent runs skip compilation. Compiled templates
+    older than `ttl` seconds are ignored (all of them if `ttl` is 0), as
+    installed gears may have changed.
+
+    Args:
+        ttl (int): Maximum age (in seconds) of a loaded compiled template.
+            Defaults to 86400.
+
+    """
+
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self._compiled = dict()  # (template_hash, host) -> compiled template
+        self._lock = threading.Lock()
+
+    def get(self, fw, template):
+        """Return the compiled form of <template> for the instance of <fw>,
+        compiling it if needed.
+
+        Returns:
+            dict: Compiled template, with 'rules' (normalized, with the gear ids
+                of this instance) and 'skipped_rules' (names of the rules whose
+                gear is missing).
+
+        Raises:
+            ValueError: If the template is invalid.
+
+        """
+
+        key = (get_template_hash(template), get_instance_host(fw))
+        with self._lock:
+            if key not in self._compiled:
+                self._compiled[key] = self.compile(fw, template, *key)
+            return self._compiled[key]
+
+    @METRICS.phase('compile_template')
+    def compile(self, fw, template, template_hash, host):
+        validate_template(template)
+        # Templates are iterated rather than indexed, so that a TemplateStream
+        # is parsed one rule at a time
+        rules = iter_template_items(template, 'rules')
+        gear_ids = resolve_template_gears(fw, rules) if has_template_items(template, 'rules') else dict()
+        compiled = {'version': COMPILED_TEMPLATE_VERSION, 'template_hash': template_hash, 'instance': host,
+                    'compiled_at': time.time(), 'rules': list(), 'skipped_rules': list()}
+        for rule in iter_template_items(template, 'rules'):
+            if gear_ids.get(rule['gear_id']):
+                compiled['rules'].append(normalize_template_rule(rule, gear_ids[rule['gear_id']]))
+            else:
+                compiled['skipped_rules'].append(rule['name'])
+        log.info(f'Compiled template {template_hash[:12]}: {len(compiled["rules"])} rules '
+                 f'({len(compiled["skipped_rules"])} skipped)')
+        return compiled
+
+    def load(self, filename, host=None):
+        """Load compiled templates saved by a previous run. Templates compiled
+        for another instance, by another format version, or more than `ttl`
+        seconds ago are ignored."""
+        try:
+            with open(filename) as cf:
+                data = json.load(cf)
+        except (OSError, ValueError) as err:
+            log.warning(f'Could not load compiled templates {filename}: {err}')
+            return
+        loaded = 0
+        for compiled in data.get('templates', []):
+            if compiled.get('version') != COMPILED_TEMPLATE_VERSION or compiled.get('instance') != host or \
+                    time.time() - compiled.get('compiled_at', 0) >= self.ttl:
+                continue
+            with self._lock:
+                self._compiled[(compiled['template_hash'], host)] = compiled
+            loaded += 1
+        log.info(f'Loaded {loaded} of {len(data.get("templates", []))} compiled templates from {filename}')
+
+    def save(self, filename):
+        """Save the compiled templates of the run to a JSON file.
+
+        Returns:
+            str: Full path to the saved file.
+
+        """
+
+        with self._lock:
+            templates = list(self._compiled.values())
+        with open(filename, 'w') as cf:
+            json.dump({'version': COMPILED_TEMPLATE_VERSION, 'templates': templates}, cf)
+        return filename
+
+
+TEMPLATE_COMPILER = TemplateCompiler()
+
+
+@METRICS.phase('apply_template_to_project')
 def apply_template_to_project(gear_context, project, template, fixed_input_archive=None):
     """Apply default group (defcault) or template permissions, and gear rules to <project>.
 
@@ -319,144 +3397,97 @@ def apply_template_to_project(gear_context, project, template, fixed_input_archi
     """
 
     fw = gear_context.client
+    max_workers = gear_context.config.get('max_workers', DEFAULT_MAX_WORKERS)
     EXIT_STATUS = 0
-    
+    plan = Plan(project)
+
     # Permissions
-    if (gear_context.config.get('permissions') and template.get('permissions')) or gear_context.config.get('default_group_permissions'):
-        log.info('APPLYING PERMISSIONS TO PROJECT...')
-        all_users = [ x.id for x in fw.get_all_users() ]
-        users = [ x.id for x in project.permissions ]
+    if (gear_context.config.get('permissions') and has_template_items(template, 'permissions')) or gear_context.config.get('default_group_permissions'):
+        log.info('PLANNING PERMISSIONS OF PROJECT...')
         if gear_context.config.get('default_group_permissions'):
             log.info(f'Applying default group permissions...')
-            permissions = fw.get_group(project.group).permissions_template
+            permissions = API.read(fw.get_group, project.group).permissions_template
             
         else:
-            permissions = template['permissions']
-            
-        for permission in permissions:
-            
-            log.debug(pp(permission))
-            
-            if not isinstance(permission, flywheel.models.roles_role_assignment.RolesRoleAssignment):
-                permission = flywheel.RolesRoleAssignment(permission['id'], permission['role_ids'])
-            if (permission.id not in users) and (permission.id in all_users):
-                log.info(' Adding {} to {}'.format(permission.id, project.label))
-                project.add_permission(permission)
-            else:
-                log.warning(' {} will not be added to {}. The user is either already in the project or not a valid user.'.format(permission.id, project.label))
-        log.info('...PERMISSIONS APPLIED')
+            permissions = list(iter_template_items(template, 'permissions'))
+
+        step_digest = get_digest([p.to_dict() if hasattr(p, 'to_dict') else p for p in permissions or []])
+        if JOURNAL.is_done(project.id, 'step', 'permissions', digest=step_digest):
+            log.info('Permissions were applied by a previous run (see journal). Skipping.')
+        else:
+            permission_ops = plan_permissions(plan, fw, project, permissions, max_workers)
+            plan.add('step', 'permissions', functools.partial(JOURNAL.record, project.id, 'step', 'permissions', digest=step_digest),
+                     permission_ops, digest=step_digest)
     else:
         log.info('NOT APPLYING PERMISSIONS TO PROJECT!')
 
 
     # Handle Fixed Inputs
-    if gear_context.config.get('gear_rules') and template.get('rules'):
+    if gear_context.config.get('gear_rules') and has_template_items(template, 'rules'):
 
         
-        log.info('APPLYING GEAR RULES TO PROJECT...')
+        log.info('PLANNING GEAR RULES OF PROJECT...')
+        upload_ops = dict()
         if fixed_input_archive:
-            log.info('Unpacking and uploading fixed gear inputs...')
-            upload_fixed_inputs(fixed_input_archive, project)
-            log.info('...Done.')
+            upload_ops = plan_fixed_inputs(plan, fixed_input_archive, project, max_workers,
+                                           gear_context.config.get('incremental_fixed_inputs', True))
+            if upload_ops is None:
+                EXIT_STATUS = 1
 
 
-        # Gear Rules
-        gear_rules = list()
-        for rule in template['rules']:
-            log.info(' Generating new rule from tempalte: {}'.format(rule['name']))
+        with METRICS.phase('gear_rules'):
+            # Gear Rules
             try:
-                # If the gear does not exist, we are probably on another instance and
-                # need to look it up.
-                log.info('Locating gear {}...'.format(rule['gear_id']))
-                gear = fw.get_gear(rule['gear_id'])
-                log.info('Found {},{}:{}'.format(rule['gear_id'], rule['gear']['name'], rule['gear']['version']))
-            except:
-                log.warning('Gear ID {} cannot be found on this system!'.format(rule['gear_id']))
-                try:
-                    log.info('Checking for the gear locally...')
-                    gear = fw.lookup('gears/{}/{}'.format(rule['gear']['name'], rule['gear']['version']))
-                    rule['gear_id'] = gear.id
-                except:
-                    log.error('{}:{} was not found on this system! Please install it!'.format(rule['gear']['name'], rule['gear']['version']))
-                    log.warning('Skipping this rule! {}'.format(rule['name']))
+                compiled = TEMPLATE_COMPILER.get(fw, template)
+            except ValueError as err:
+                log.error(err)
+                compiled = None
+                EXIT_STATUS = 1
+            if compiled:
+                for name in compiled['skipped_rules']:
+                    log.warning('Skipping this rule! {}'.format(name))
                     EXIT_STATUS = 1
-                    continue
-
-            rule['project_id'] = project.id
-            rule['id'] = None
-            if 'gear' in rule:
-                del rule['gear']
-
-            # For each fixed input, fix the project id
-            if rule['fixed_inputs']:
-                for fi in range(0, len(rule['fixed_inputs'])):
-                    rule['fixed_inputs'][fi]['id'] = project.id
-                    rule['fixed_inputs'][fi]['type'] = "project"
-                    if not rule['fixed_inputs'][fi]['base']:
-                        del rule['fixed_inputs'][fi]['base']
-                    if not rule['fixed_inputs'][fi]['found']:
-                        del rule['fixed_inputs'][fi]['found']
-
-            # Fix all and any fields
-            if rule['all']:
-                for ar in range(0, len(rule['all'])):
-                    if not rule['all'][ar]['regex']:
-                        rule['all'][ar]['regex'] = False
-            if rule['any']:
-                for ar in range(0, len(rule['any'])):
-                    if not rule['any'][ar]['regex']:
-                        rule['any'][ar]['regex'] = False
-            if rule['_not']:
-                log.debug('RULE NOT')
-                for ar in range(0, len(rule['_not'])):
-                    if not rule['_not'][ar]['regex']:
-                        log.debug('setting to false...')
-                        rule['_not'][ar]['regex'] = False
-
-            # Forumlate the gear_rule
-            gear_rules.append(flywheel.models.rule.Rule(project_id=project.id,
-                                                 gear_id=rule['gear_id'],
-                                                 name=rule['name'],
-                                                 config=rule['config'],
-                                                 fixed_inputs=rule['fixed_inputs'],
-                                                 auto_update=rule['auto_update'],
-                                                 any=rule['any'],
-                                                 all=rule['all'],
-                                                 _not=rule['_not'],
-                                                 disabled=rule['disabled']))
-
-        project_rules = [x for x in fw.get_project_rules(project.id)]
-        project_rule_names = [x.name for x in fw.get_project_rules(project.id)]
-        log.debug(project_rule_names)
-        RULE_ACTION = gear_context.config.get('existing_rules')
-
-        for gear_rule in gear_rules:
-            if gear_rule.get('name') in project_rule_names:
-                log.warning('A matching rule for \'{}\' was already found on this project.'.format(gear_rule.get('name')))
-                matching_rule = [ x for x in fw.get_project_rules(project.id) if x.name == gear_rule.get('name') ]
-                if RULE_ACTION == "REPLACE":
-                    for mr in matching_rule:
-                        log.info('REPLACE action was configured. Deleting the matching rule.')
-                        fw.remove_project_rule(project.id, mr.id)
-                elif RULE_ACTION == "SKIP":
-                    log.info('SKIP action was configured. Not adding rule from template.')
-                    continue
-                elif RULE_ACTION == "APPEND":
-                    log.warning('APPEND action was configured. Template rule will be added - duplicates will exist.')
-            try:
-                log.info('Adding "{}" rule to "{} (id={})" project'.format(gear_rule['name'], project.label, project.id))
-                fw.add_project_rule(project.id, gear_rule)
-            except flywheel.ApiException as err:
-                log.error(f'API error during gear rule creation: {err.status} -- {err.reason} -- {err.detail}. \nBailing out!')
-                log.debug(gear_rule)
-                os._exit(1)
-        log.info('...GEAR RULES APPLIED TO PROJECT!')
+                gear_rules = list()
+                for rule in compiled['rules']:
+                    fixed_inputs = [dict(fixed_input, id=project.id) for fixed_input in rule['fixed_inputs']]
+                    gear_rules.append(flywheel.models.rule.Rule(project_id=project.id, **dict(rule, fixed_inputs=fixed_inputs)))
+
+                RULE_ACTION = gear_context.config.get('existing_rules')
+                step_digest = get_digest([get_rule_signature(r) for r in gear_rules] + [RULE_ACTION])
+                if JOURNAL.is_done(project.id, 'step', 'gear_rules', digest=step_digest):
+                    log.info('Gear rules were applied by a previous run (see journal). Skipping.')
+                else:
+                    # Single fetch of the existing rules, which are then reconciled with the template
+                    existing_rules = API.read(fw.get_project_rules, project.id) if project.id else list()
+                    log.debug([x.name for x in existing_rules])
+
+                    diff = diff_project_rules(gear_rules, existing_rules, RULE_ACTION)
+                    rule_ops = plan_rule_diff(plan, fw, project, diff, upload_ops)
+                    if not compiled['skipped_rules']:
+                        plan.add('step', 'gear_rules',
+                                 functools.partial(JOURNAL.record, project.id, 'step', 'gear_rules', digest=step_digest),
+                                 rule_ops, digest=step_digest)
     else:
         log.info('NOT APPLYING GEAR RULES TO PROJECT! (config.gear_fules=False)')
 
+    plan_name = re.sub(r'[^\w.-]', '_', str(project.id or f'{project.group}-{project.label}'))
+    plan_name = os.path.join(gear_context.output_dir, f'project-settings_plan_{plan_name}.json')
+    plan.save(plan_name)
+    if gear_context.config.get('dry_run'):
+        log.info(f'Dry run: {len(plan.operations)} operations planned for {project.group}/{project.label}, '
+                 f'none executed. Plan saved to {plan_name}')
+        return EXIT_STATUS
+
+    log.info(f'APPLYING {len(plan.operations)} PLANNED OPERATIONS TO PROJECT...')
+    if plan.execute(max_workers):
+        EXIT_STATUS = 1
+    plan.save(plan_name)
+    log.info('...SETTINGS APPLIED TO PROJECT!')
+
     return EXIT_STATUS
 
 
+@METRICS.phase('get_valid_project')
 def get_valid_project(gear_context):
     """Use the <gear_context> to parse the destination and use it to determine
         a vaild project. The destination should be an analysis, and the parent of
@@ -469,32 +3500,37 @@ def get_valid_project(gear_context):
         :obj:flywheel.models.project.Project: Flywheel Project which has the
             existing permissions and gear rules.
 
+    Raises:
+        ValueError: If the destination is not an analysis of a project.
+
     """
 
     if gear_context.destination['type'] != "analysis":
-        msg = 'Destination must be an analysis!'
-        log.error(msg)
-        os._exit(1)
+        raise ValueError('Destination must be an analysis!')
 
-    analysis = gear_context.client.get_analysis(gear_context.destination['id'])
+    analysis = API.read(gear_context.client.get_analysis, gear_context.destination['id'])
 
     try:
-        project = gear_context.client.get_project(analysis.parent['id'])
+        project = API.read(gear_context.client.get_project, analysis.parent['id'])
     except flywheel.ApiException as err:
-        log.error(f'Could not retrieve source project. This Gear must be run at the project level!: {err.status} -- {err.reason} -- {err.detail}. \nBailing out!')
-        os._exit(1)
+        raise ValueError(f'Could not retrieve source project. This Gear must be run at the project level!: {err.status} -- {err.reason} -- {err.detail}. \nBailing out!')
 
     return project
 
 
+@METRICS.phase('load_template_from_input')
 def load_template_from_input(template_file):
     """Load json template from file.
 
+    Templates in the line-delimited format are not loaded, but returned as a
+    TemplateStream which is read lazily.
+
     Args:
         template_file (str): Full path to JSON template file.
 
     Returns:
-        dict: Project template containing 'permissions', and 'rules':
+        dict: Project template containing 'permissions', and 'rules' (or a
+            TemplateStream):
             {
               "permissions": [],
               "rules": []
@@ -503,6 +3539,8 @@ def load_template_from_input(template_file):
     """
 
     log.info(f'Loading existng template file: {template_file}')
+    if TemplateStream.is_stream(template_file):
+        return TemplateStream(template_file)
     with open(template_file, 'r') as tf:
         template = json.load(tf)
 
@@ -517,47 +3555,120 @@ if __name__ == "__main__":
                           # and fixed input archive will be generated.
 
     EXIT_STATUS = 0
+    fixed_input_archive = None
 
     with flywheel.gear_context.GearContext() as gear_context:
 
         gear_context.init_logging()
         log.setLevel(gear_context.config['gear-log-level'])
-        log.info('Destination: {}'.format(gear_context.destination))
-        log.info('Config: {}'.format(gear_context.config))
-
-        source_project = get_valid_project(gear_context)
-
-        # If the user has supplied a template then we load from file, otherwise
-        # we generate from the source project.
-        if gear_context.get_input_path('template'):
-            template = load_template_from_input(gear_context.get_input_path('template'))
-            APPLY_FROM_INPUT = True
-        else:
-            template = generate_project_template(gear_context, source_project)
-            APPLY_FROM_INPUT = False
-
-        if gear_context.config.get('gear_rules'):
-            if gear_context.get_input_path('fixed_inputs'):
-                fixed_input_archive = gear_context.get_input_path('fixed_inputs')
+        PROFILER.start(gear_context.config.get('profiling', 'OFF'), gear_context.output_dir)
+        source_project = instance_host = None
+        try:
+            log.info('Destination: {}'.format(gear_context.destination))
+            log.info('Config: {}'.format(gear_context.config))
+
+            max_workers = gear_context.config.get('max_workers', DEFAULT_MAX_WORKERS)
+            max_projects = gear_context.config.get('max_concurrent_projects', 2) if gear_context.config.get('clone_project_paths') or gear_context.config.get('export_project_paths') else 1
+            API.max_retries = gear_context.config.get('api_max_retries', API.max_retries)
+            API.timeout = gear_context.config.get('api_timeout', API.timeout)
+            API.max_concurrency = max_workers * max_projects
+            API.limit = float(API.max_concurrency)
+            API.max_transfers = max_workers * max_projects
+            API.configure_session(gear_context.client, API.max_concurrency + API.max_transfers + 4)
+
+            GEAR_CACHE.ttl = gear_context.config.get('gear_cache_ttl', GEAR_CACHE.ttl)
+            instance_host = get_instance_host(gear_context.client)
+            if gear_context.get_input_path('gear_cache'):
+                GEAR_CACHE.load(gear_context.get_input_path('gear_cache'), instance_host)
+            TEMPLATE_COMPILER.ttl = GEAR_CACHE.ttl
+            if gear_context.get_input_path('compiled_templates'):
+                TEMPLATE_COMPILER.load(gear_context.get_input_path('compiled_templates'), instance_host)
+            if gear_context.get_input_path('journal'):
+                JOURNAL.load(gear_context.get_input_path('journal'))
+            JOURNAL.open(os.path.join(gear_context.output_dir, JOURNAL_FILENAME))
+
+            source_project = get_valid_project(gear_context)
+
+            if gear_context.config.get('export_project_paths'):
+                # Bulk export of the listed projects into a single bundle
+                EXIT_STATUS = export_bundle(gear_context, gear_context.config.get('export_project_paths'))
+                APPLY_TEMPLATE = False
             else:
-                fixed_input_archive = download_fixed_inputs(gear_context, template, source_project.id)
-
-        if gear_context.config.get('clone_project_path'):
-            # If a clone_project_path was provided, attempt to create the project,
-            # or find an existing project and return it.
-            clone_project = create_project(gear_context)
-        elif APPLY_FROM_INPUT:
-            # If the input template was already provided then the clone_projet
-            # is the source_project
-            log.info('Applyting template from input. Setting clone project to source.')
-            clone_project = source_project
-        else:
-            # We're just exporting a template.
-            log.info('Exporting template... Done!')
-            APPLY_TEMPLATE = False
-
-        if APPLY_TEMPLATE:
-            EXIT_STATUS = apply_template_to_project(gear_context, clone_project, template, fixed_input_archive)
+                # If the user has supplied a template then we load from file, otherwise
+                # we generate from the source project.
+                baseline = None
+                if gear_context.get_input_path('template'):
+                    template = load_template_from_input(gear_context.get_input_path('template'))
+                    APPLY_FROM_INPUT = True
+                else:
+                    # A baseline (previous export) makes this a delta export
+                    if gear_context.get_input_path('baseline_template'):
+                        baseline = load_template_from_input(gear_context.get_input_path('baseline_template'))
+                    template = generate_project_template(gear_context, source_project, baseline=baseline)
+                    APPLY_FROM_INPUT = False
+
+                if gear_context.config.get('gear_rules'):
+                    if gear_context.get_input_path('fixed_inputs'):
+                        fixed_input_archive = gear_context.get_input_path('fixed_inputs')
+                    else:
+                        fixed_input_archive = download_fixed_inputs(gear_context, template, source_project.id,
+                                                                    gear_context.get_input_path('baseline_fixed_inputs'))
+
+                if baseline is not None:
+                    patch = generate_template_patch(baseline, template, gear_context.get_input_path('baseline_fixed_inputs'),
+                                                    fixed_input_archive)
+                    save_template(patch, os.path.join(gear_context.output_dir,
+                                                      'project-settings_template-patch_{}.json'.format(source_project.id)))
+                    log.info('Changes since the baseline: {}'.format(', '.join(
+                        f'{section} +{len(patch[section]["added"])} ~{len(patch[section]["changed"])} '
+                        f'-{len(patch[section]["removed"])}' for section in ['rules', 'permissions', 'fixed_inputs'])))
+
+                if gear_context.config.get('clone_project_paths'):
+                    # Apply the template to each of the listed projects
+                    EXIT_STATUS = apply_template_to_projects(gear_context, template, fixed_input_archive, source_project)
+                    APPLY_TEMPLATE = False
+                elif gear_context.config.get('clone_project_path'):
+                    # If a clone_project_path was provided, attempt to create the project,
+                    # or find an existing project and return it.
+                    clone_project = create_project(gear_context)
+                    if clone_project is None:
+                        EXIT_STATUS = 1
+                        APPLY_TEMPLATE = False
+                elif APPLY_FROM_INPUT:
+                    # If the input template was already provided then the clone_projet
+                    # is the source_project
+                    log.info('Applyting template from input. Setting clone project to source.')
+                    clone_project = source_project
+                else:
+                    # We're just exporting a template.
+                    log.info('Exporting template... Done!')
+                    APPLY_TEMPLATE = False
+
+            if APPLY_TEMPLATE:
+                EXIT_STATUS = apply_template_to_project(gear_context, clone_project, template, fixed_input_archive)
+
+            if gear_context.config.get('save_gear_cache'):
+                GEAR_CACHE.save(os.path.join(gear_context.output_dir, GEAR_CACHE_FILENAME), instance_host)
+            if gear_context.config.get('save_compiled_templates'):
+                TEMPLATE_COMPILER.save(os.path.join(gear_context.output_dir, COMPILED_TEMPLATE_FILENAME))
+        except ValueError as err:
+            log.error(err)
+            EXIT_STATUS = 1
+        except Exception:
+            log.exception('Unexpected error')
+            EXIT_STATUS = 1
+        finally:
+            # Failed (and interrupted) runs are the ones whose metrics and profiles matter most
+            JOURNAL.close()
+            try:
+                metrics_id = source_project.id if source_project else gear_context.destination.get('id')
+                METRICS.save(os.path.join(gear_context.output_dir, 'project-settings_metrics_{}.json'.format(metrics_id)),
+                             gear_version=get_gear_version(), instance=instance_host, config=gear_context.config,
+                             exit_status=EXIT_STATUS)
+                if gear_context.config.get('log_metrics_summary', True):
+                    log.info(METRICS.summary())
+            finally:
+                PROFILER.stop()
 
     if EXIT_STATUS == 0:
         log.info('Done!')
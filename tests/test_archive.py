@@ -0,0 +1,126 @@
+"""Round-trip checks of the fixed input archives: every codec, and the raw
+member writes and copies (`write_compressed_member`, `copy_archive_file`)
+which rely on zipfile internals (see RAW_MEMBER_PYTHON_VERSIONS).
+
+Run with `python -m unittest discover tests` (or pytest).
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+try:
+    import flywheel  # noqa: F401
+except ImportError:  # The archive code does not use the SDK, the fake client of the benchmarks will do
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    import fake_flywheel
+    fake_flywheel.install()
+
+import run
+
+CODECS = ['deflate', 'bzip2', 'lzma', 'zstd']
+
+
+def make_files(content_dir):
+    """Write a compressible, an incompressible and an already compressed file,
+    and return their content keyed by name."""
+    files = {'atlas.txt': b'gray matter, white matter\n' * 50000,
+             'noise.bin': os.urandom(200000),
+             'template.nii.gz': os.urandom(100000),
+             'empty.json': b''}
+    os.makedirs(content_dir)
+    for name, content in files.items():
+        with open(os.path.join(content_dir, name), 'wb') as fp:
+            fp.write(content)
+    return files
+
+
+def get_manifest(files):
+    return {name: {'size': len(content), 'sha384': hashlib.sha384(content).hexdigest(), 'platform_hash': None}
+            for name, content in files.items()}
+
+
+class ArchiveRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def skip_unavailable(self, codec):
+        if codec == 'zstd' and run.zstandard is None:
+            self.skipTest('zstandard is not installed')
+
+    def create(self, name, codec, files=None, copy_files=None):
+        content_dir = os.path.join(self.tmpdir, name)
+        files = make_files(content_dir) if files is None else files
+        if not os.path.isdir(content_dir):
+            os.makedirs(content_dir)
+        manifest = get_manifest(files)
+        path = run.create_archive(content_dir, name, os.path.join(self.tmpdir, name + '.zip'), manifest, codec,
+                                  max_workers=2, copy_files=copy_files)
+        return path, files
+
+    def assert_archive(self, path, files, codec):
+        with zipfile.ZipFile(path) as zf:
+            self.assertIsNone(zf.testzip())
+            archive_files = run.get_archive_files(zf)
+            self.assertEqual(sorted(f.name for f in archive_files), sorted(files))
+            for archive_file in archive_files:
+                with run.open_archive_file(zf, archive_file) as stream:
+                    content = stream.read()
+                self.assertEqual(content, files[archive_file.name], archive_file.name)
+                self.assertEqual(archive_file.size, len(content))
+                self.assertEqual(archive_file.sha384, hashlib.sha384(content).hexdigest())
+                if archive_file.name == 'atlas.txt':
+                    self.assertEqual(archive_file.codec.name, codec)
+                elif archive_file.name in ('noise.bin', 'template.nii.gz'):
+                    # Not shrinking, or already compressed
+                    self.assertEqual(archive_file.codec.name, 'store')
+
+    def test_create_archive(self):
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                self.skip_unavailable(codec)
+                path, files = self.create(f'create-{codec}', codec)
+                self.assert_archive(path, files, codec)
+
+    def test_copy_from_baseline(self):
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                self.skip_unavailable(codec)
+                baseline, files = self.create(f'baseline-{codec}', codec)
+                with zipfile.ZipFile(baseline) as zf:
+                    copy_files = [(baseline, f) for f in run.get_archive_files(zf)]
+                path, _ = self.create(f'delta-{codec}', 'store', files=dict(), copy_files=copy_files)
+                self.assert_archive(path, files, codec)
+
+    def test_streaming_writer_copy(self):
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                self.skip_unavailable(codec)
+                baseline, files = self.create(f'stream-baseline-{codec}', codec)
+                path = os.path.join(self.tmpdir, f'stream-{codec}.zip')
+                extra = b'new file\n' * 1000
+                with zipfile.ZipFile(baseline) as zf, run.StreamingArchiveWriter(path, 'stream', codec) as writer:
+                    for archive_file in run.get_archive_files(zf):
+                        writer.copy_file(baseline, archive_file)
+                    writer.add_stream('extra.txt', [extra])
+                self.assert_archive(path, dict(files, **{'extra.txt': extra}), codec)
+
+
+@mock.patch.object(run, 'RAW_MEMBERS', False)
+class PublicApiArchiveRoundTripTest(ArchiveRoundTripTest):
+    """The same checks, on the public zipfile API used outside of RAW_MEMBER_PYTHON_VERSIONS."""
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Ranged downloads of project files: parallel ranges, and resuming from an
+offset, which both rely on the platform honouring the Range header.
+
+Run with `python -m unittest discover tests` (or pytest).
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import fake_flywheel  # noqa: E402
+
+fake_flywheel.install()
+
+import run  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class RangedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fw = fake_flywheel.FakeClient()
+        self.fw.seed_group('group')
+        self.project = self.fw.seed_project('group', 'project')
+        self.blob = fake_flywheel.SyntheticBlob(4 * MB, seed=7)
+        self.project.add_file('atlas.nii.gz', self.blob)
+        self.content = b''.join(self.blob.iter_chunks())
+        fake_flywheel.mount(run.get_http_session(), self.fw)
+
+    def download(self, **kwargs):
+        with mock.patch.object(run, 'fetch_range', wraps=run.fetch_range) as fetch_range:
+            content = b''.join(run.iter_file_download(self.project, 'atlas.nii.gz', chunk_size=MB,
+                                                      size=self.blob.size, **kwargs))
+        return content, fetch_range.call_count
+
+    def test_parallel_ranges(self):
+        content, fetches = self.download(parallel=4)
+        self.assertEqual(content, self.content)
+        # One request per range, none of them falling back to a single stream
+        self.assertEqual(fetches, 4)
+
+    def test_resume_from_offset(self):
+        content, _ = self.download(offset=MB + 5)
+        self.assertEqual(content, self.content[MB + 5:])
+
+    def test_server_without_range_support(self):
+        self.fw.range_requests = False
+        content, fetches = self.download(parallel=4)
+        self.assertEqual(content, self.content)
+        self.assertEqual(fetches, 1)
+        with self.assertRaises(run.RangeNotSupportedError):
+            self.download(offset=MB)
+
+
+if __name__ == '__main__':
+    unittest.main()
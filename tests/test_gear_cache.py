@@ -0,0 +1,68 @@
+"""Resolution of the gears of template rules through the GearCache index of
+installed gears.
+
+Run with `python -m unittest discover tests` (or pytest).
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import fake_flywheel  # noqa: E402
+
+fake_flywheel.install()
+
+import run  # noqa: E402
+
+
+class GearIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fw = fake_flywheel.FakeClient()
+        self.cache = run.GearCache()
+        patches = [mock.patch.object(run, 'GEAR_CACHE', self.cache), mock.patch.object(run, 'API', run.ApiExecutor())]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def resolve(self, *gear_docs):
+        rules = [{'gear_id': g.id, 'gear': {'name': g.gear.name, 'version': g.gear.version}} for g in gear_docs]
+        return run.resolve_template_gears(self.fw, rules)
+
+    def test_invalid_gear_is_indexed(self):
+        valid = self.fw.seed_gear('dcm2niix', '1.0.0')
+        invalid = self.fw.seed_gear('dcm2niix', '0.9.0', invalid=True)
+        self.assertEqual(self.resolve(valid, invalid), {valid.id: valid.id, invalid.id: invalid.id})
+        self.assertEqual(self.fw.calls['get_all_gears'], 1)
+        self.assertEqual(self.fw.calls['get_gear'], 0)
+
+    def test_gear_missing_from_index_is_looked_up(self):
+        listed = [self.fw.seed_gear(f'gear-{i}', '1.0.0') for i in range(3)]
+        unlisted = self.fw.seed_gear('unlisted', '2.0.0')
+        # e.g. the listing was truncated by a server-side limit
+        with mock.patch.object(self.fw, 'get_all_gears', return_value=listed):
+            resolved = self.resolve(*listed, unlisted, unlisted)
+        self.assertEqual(resolved[unlisted.id], unlisted.id)
+        self.assertEqual(len(resolved), 4)
+        self.assertEqual(self.fw.calls['get_gear'], 1)
+
+    def test_missing_gear_is_looked_up_once(self):
+        gear = self.fw.seed_gear('bids-fmriprep', '1.2.0')
+        foreign = fake_flywheel.GearDoc(id='f' * 24, gear=fake_flywheel.GearManifest(name='bids-fmriprep', version='1.2.0'))
+        uninstalled = fake_flywheel.GearDoc(id='e' * 24, gear=fake_flywheel.GearManifest(name='qsiprep', version='0.1'))
+        with self.assertLogs(run.log, 'ERROR') as logs:
+            self.assertEqual(self.resolve(gear, foreign, uninstalled), {gear.id: gear.id, foreign.id: gear.id})
+            self.resolve(gear, foreign, uninstalled)
+        self.assertIn('qsiprep:0.1 was not found', logs.output[0])
+        # One get_gear for each of the two gears not in the index, one lookup for the one not found by name either
+        self.assertEqual(self.fw.calls['get_gear'], 2)
+        self.assertEqual(self.fw.calls['lookup'], 1)
+        self.assertEqual(self.fw.calls['get_all_gears'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Resuming an interrupted run from its operation journal (OperationJournal).
+
+Run with `python -m unittest discover tests` (or pytest).
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import fake_flywheel  # noqa: E402
+
+fake_flywheel.install()
+
+import run  # noqa: E402
+import run_benchmarks  # noqa: E402
+
+
+def read_journal(filename):
+    with open(filename) as jf:
+        return [json.loads(line) for line in jf]
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for patch in (mock.patch.object(run, 'API', run.ApiExecutor()),
+                      mock.patch.object(run, 'GEAR_CACHE', run.GearCache())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def wait_for(self, condition, timeout=60):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail('Timed out waiting for the interrupted run')
+            time.sleep(0.01)
+
+    def test_resume_interrupted_run(self):
+        # 10 rules, the even ones using one of 4 fixed inputs: only rule-6 uses atlas-3.nii.gz
+        case = {'rules': 10, 'users': 20, 'permissions': 5, 'fixed_input_size': 4 * 1024 * 1024, 'fixed_inputs': 4,
+                'latency': 0, 'bandwidth': None}
+        fw, source = run_benchmarks.seed_instance(fake_flywheel, case)
+        fake_flywheel.mount(run.get_http_session(), fw)
+        config = {'permissions': True, 'gear_rules': True, 'existing_rules': 'REPLACE', 'max_workers': 1,
+                  'apply_to_existing_project': True}
+        gear_context = fake_flywheel.FakeGearContext(fw, self.tmpdir, config)
+        template = run.generate_project_template(gear_context, source)
+        archive = run.download_fixed_inputs(gear_context, template, source.id)
+        project = run.get_or_create_project(fw, 'bench', 'clone')
+
+        # First run, interrupted while uploading the last file: the other
+        # uploads (one at a time) are done, and so is everything not waiting for it
+        blocked, release = threading.Event(), threading.Event()
+        upload_file = fake_flywheel.FakeContainer.upload_file
+
+        def interrupted_upload(container, file):
+            if file.name == 'atlas-3.nii.gz':
+                blocked.set()
+                release.wait()
+                raise fake_flywheel.ApiException(400, 'Bad Request', 'Run killed')
+            return upload_file(container, file)
+
+        journal = run.OperationJournal()
+        journal_path = os.path.join(self.tmpdir, 'first-journal.jsonl')
+        journal.open(journal_path)
+        with mock.patch.object(run, 'JOURNAL', journal), \
+                mock.patch.object(fake_flywheel.FakeContainer, 'upload_file', interrupted_upload):
+            first_run = threading.Thread(target=run.apply_template_to_project,
+                                         args=(gear_context, project, template, archive))
+            first_run.start()
+            try:
+                self.assertTrue(blocked.wait(60))
+                self.wait_for(lambda: [e['operation'] for e in read_journal(journal_path)].count('rule_add') == 9 and
+                              journal.get(project.id, 'step', 'permissions'))
+                # What a run killed at this point leaves behind
+                killed_journal = os.path.join(self.tmpdir, 'killed-journal.jsonl')
+                shutil.copy(journal_path, killed_journal)
+            finally:
+                release.set()
+                first_run.join()
+        journal.close()
+
+        entries = read_journal(killed_journal)
+        self.assertEqual(sorted(e['key'] for e in entries if e['operation'] == 'upload'),
+                         ['atlas-0.nii.gz', 'atlas-1.nii.gz', 'atlas-2.nii.gz'])
+        self.assertEqual(sum(e['operation'] == 'permission' for e in entries), case['permissions'])
+
+        # Rerun with the journal of the killed run
+        journal = run.OperationJournal()
+        journal.load(killed_journal)
+        journal.open(os.path.join(self.tmpdir, 'second-journal.jsonl'))
+        fw.calls.clear()
+        with mock.patch.object(run, 'API', run.ApiExecutor()), mock.patch.object(run, 'JOURNAL', journal):
+            self.assertEqual(run.apply_template_to_project(gear_context, project, template, archive), 0)
+        journal.close()
+
+        # Only the upload of the last file, and the rule using it, are left to do
+        self.assertEqual(fw.calls['upload_file'], 1)
+        self.assertEqual(fw.calls['add_project_rule'], 1)
+        self.assertEqual(fw.calls['add_permission'], 0)
+        self.assertEqual(fw.calls['get_user'], 0)
+        self.assertEqual(fw.calls['modify_project_rule'] + fw.calls['remove_project_rule'], 0)
+        self.assertEqual(sorted(f.name for f in project.files), [f'atlas-{i}.nii.gz' for i in range(4)])
+        self.assertEqual(sorted(rule.name for rule in fw.rules[project.id]), sorted(f'rule-{i}' for i in range(10)))
+        self.assertTrue(journal.get(project.id, 'step', 'gear_rules'))
+        self.assertTrue(journal.get(project.id, 'step', 'fixed_inputs'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Scheduling of the operations of a Plan: a gear rule only waits for the
+uploads of its own fixed inputs, never for unrelated ones.
+
+Run with `python -m unittest discover tests` (or pytest).
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import fake_flywheel  # noqa: E402
+
+fake_flywheel.install()
+
+import run  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class PlanSchedulingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_archive(self, files):
+        content_dir = os.path.join(self.tmpdir, 'fixed_inputs')
+        os.makedirs(content_dir)
+        manifest = dict()
+        for name, content in files.items():
+            with open(os.path.join(content_dir, name), 'wb') as fp:
+                fp.write(content)
+            manifest[name] = {'size': len(content), 'sha384': hashlib.sha384(content).hexdigest(),
+                              'platform_hash': None}
+        return run.create_archive(content_dir, 'fixed_inputs', manifest=manifest, codec='store')
+
+    def test_rule_does_not_wait_for_unrelated_uploads(self):
+        files = {'a-large.bin': os.urandom(MB), 'b-large.bin': os.urandom(MB), 'c-small.json': b'{}'}
+        archive = self.create_archive(files)
+        fw = fake_flywheel.FakeClient()
+        fw.seed_group('group')
+        project = fw.seed_project('group', 'project')
+
+        # The large uploads only complete once the rule has been added (or
+        # after a timeout, which fails the test)
+        release, timed_out = threading.Event(), threading.Event()
+        upload_file = fake_flywheel.FakeContainer.upload_file
+
+        def blocking_upload(container, file):
+            if file.name.endswith('-large.bin') and not release.wait(30):
+                timed_out.set()
+            return upload_file(container, file)
+
+        rule_ran_first = list()
+
+        def add_rule():
+            rule_ran_first.append(not release.is_set())
+            release.set()
+
+        # Fewer API slots than concurrent uploads, as when the limit is lowered
+        # after throttling: the rule needs a slot while both large uploads run
+        max_workers = 3
+        api = run.ApiExecutor(max_concurrency=2, max_transfers=max_workers)
+        with mock.patch.object(run, 'API', api), mock.patch.object(run, 'JOURNAL', run.OperationJournal()), \
+                mock.patch.object(fake_flywheel.FakeContainer, 'upload_file', blocking_upload):
+            plan = run.Plan(project)
+            upload_ops = run.plan_fixed_inputs(plan, archive, project, max_workers, incremental=False)
+            plan.add('rule_add', 'rule', lambda: api.write(add_rule), [upload_ops['c-small.json']])
+            self.assertEqual(plan.execute(max_workers), 0)
+
+        self.assertFalse(timed_out.is_set(), 'The rule waited for the large uploads')
+        self.assertEqual(rule_ran_first, [True])
+        self.assertEqual(sorted(f.name for f in project.files), sorted(files))
+
+
+if __name__ == '__main__':
+    unittest.main()
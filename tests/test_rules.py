@@ -0,0 +1,141 @@
+"""Reconciliation of template gear rules with the rules already on a project
+(`diff_project_rules`, `plan_rule_diff`) for each `existing_rules` action.
+
+Run with `python -m unittest discover tests` (or pytest).
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import fake_flywheel  # noqa: E402
+
+fake_flywheel.install()
+
+import run  # noqa: E402
+import run_benchmarks  # noqa: E402
+
+WRITE_ENDPOINTS = ('add_project_rule', 'modify_project_rule', 'remove_project_rule', 'add_permission', 'upload_file')
+
+
+class RuleDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fw = fake_flywheel.FakeClient()
+        self.fw.seed_group('group')
+        self.gear = self.fw.seed_gear('dcm2niix', '1.0.0')
+        self.project = self.fw.seed_project('group', 'project')
+        for patch in (mock.patch.object(run, 'API', run.ApiExecutor()),
+                      mock.patch.object(run, 'JOURNAL', run.OperationJournal())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def make_rule(self, name, threshold):
+        return fake_flywheel.Rule(**self.get_fields(name, threshold))
+
+    def get_fields(self, name, threshold):
+        return {'gear_id': self.gear.id, 'name': name, 'config': {'threshold': threshold}, 'fixed_inputs': [],
+                'auto_update': False, 'any': [], '_not': [], 'disabled': False,
+                'all': [{'type': 'file.type', 'value': 'dicom', 'regex': False}]}
+
+    def apply(self, action, template_rules, existing_rules):
+        """Apply <template_rules> to a project with <existing_rules>, and return
+        the rules then on the project as (id, name, threshold) tuples."""
+        existing = [self.fw.seed_rule(self.project, **self.get_fields(*rule)) for rule in existing_rules]
+        self.existing_ids = [rule.id for rule in existing]
+        diff = run.diff_project_rules([self.make_rule(*rule) for rule in template_rules],
+                                      self.fw.get_project_rules(self.project.id), action)
+        plan = run.Plan(self.project)
+        run.plan_rule_diff(plan, self.fw, self.project, diff)
+        self.assertEqual(plan.execute(), 0)
+        return [(rule.id, rule.name, rule.config['threshold']) for rule in self.fw.rules[self.project.id]]
+
+    def assert_calls(self, add=0, modify=0, remove=0):
+        self.assertEqual((self.fw.calls['add_project_rule'], self.fw.calls['modify_project_rule'],
+                          self.fw.calls['remove_project_rule']), (add, modify, remove))
+
+    def test_replace_updates_first_and_deletes_duplicates(self):
+        rules = self.apply('REPLACE', [('atlas', 3)], [('atlas', 1), ('atlas', 2), ('other', 5)])
+        a1, _, other = self.existing_ids
+        self.assertEqual(rules, [(a1, 'atlas', 3), (other, 'other', 5)])
+        self.assert_calls(modify=1, remove=1)
+
+    def test_replace_keeps_identical_duplicate(self):
+        rules = self.apply('REPLACE', [('atlas', 3)], [('atlas', 1), ('atlas', 3)])
+        self.assertEqual(rules, [(self.existing_ids[1], 'atlas', 3)])
+        self.assert_calls(remove=1)
+
+    def test_replace_adds_new_rules(self):
+        rules = self.apply('REPLACE', [('atlas', 1), ('new', 2)], [('atlas', 1)])
+        self.assertEqual([rule[1:] for rule in rules], [('atlas', 1), ('new', 2)])
+        self.assert_calls(add=1)
+
+    def test_skip_leaves_duplicates_untouched(self):
+        rules = self.apply('SKIP', [('atlas', 3), ('atlas', 4), ('new', 1)], [('atlas', 1), ('atlas', 2)])
+        self.assertEqual([rule[1:] for rule in rules], [('atlas', 1), ('atlas', 2), ('new', 1)])
+        self.assert_calls(add=1)
+
+    def test_append_adds_duplicate(self):
+        rules = self.apply('APPEND', [('atlas', 3)], [('atlas', 1), ('atlas', 2)])
+        self.assertEqual([rule[1:] for rule in rules], [('atlas', 1), ('atlas', 2), ('atlas', 3)])
+        self.assert_calls(add=1)
+
+    def test_append_skips_identical(self):
+        rules = self.apply('APPEND', [('atlas', 2)], [('atlas', 1), ('atlas', 2)])
+        self.assertEqual([rule[1:] for rule in rules], [('atlas', 1), ('atlas', 2)])
+        self.assert_calls()
+
+    def test_identical_rules_are_unchanged(self):
+        for action in ('REPLACE', 'SKIP', 'APPEND'):
+            with self.subTest(action=action):
+                existing = [self.make_rule('atlas', 1), self.make_rule('other', 2)]
+                diff = run.diff_project_rules([self.make_rule('atlas', 1), self.make_rule('other', 2)], existing, action)
+                self.assertEqual(len(diff['unchanged']), 2)
+                self.assertEqual(diff['add'] + diff['update'] + diff['delete'], [])
+
+
+class ReapplyTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for patch in (mock.patch.object(run, 'API', run.ApiExecutor()),
+                      mock.patch.object(run, 'GEAR_CACHE', run.GearCache()),
+                      mock.patch.object(run, 'JOURNAL', run.OperationJournal())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_reapplying_unchanged_template_makes_no_writes(self):
+        case = {'rules': 10, 'users': 20, 'permissions': 5, 'fixed_input_size': 4 * 1024 * 1024, 'fixed_inputs': 2,
+                'latency': 0, 'bandwidth': None}
+        fw, source = run_benchmarks.seed_instance(fake_flywheel, case)
+        fake_flywheel.mount(run.get_http_session(), fw)
+        for action in ('REPLACE', 'SKIP', 'APPEND'):
+            with self.subTest(action=action):
+                output = tempfile.mkdtemp(dir=self.tmpdir)
+                gear_context = fake_flywheel.FakeGearContext(fw, output, {
+                    'permissions': True, 'gear_rules': True, 'existing_rules': action,
+                    'apply_to_existing_project': True})
+                template = run.generate_project_template(gear_context, source)
+                archive = run.download_fixed_inputs(gear_context, template, source.id)
+                project = run.get_or_create_project(fw, 'bench', f'clone-{action.lower()}')
+                self.assertEqual(run.apply_template_to_project(gear_context, project, template, archive), 0)
+
+                # A new run (no journal, nothing cached) finds everything in place
+                fw.calls.clear()
+                with mock.patch.object(run, 'API', run.ApiExecutor()), \
+                        mock.patch.object(run, 'JOURNAL', run.OperationJournal()):
+                    self.assertEqual(run.apply_template_to_project(gear_context, project, template, archive), 0)
+                self.assertEqual({endpoint: fw.calls[endpoint] for endpoint in WRITE_ENDPOINTS},
+                                 dict.fromkeys(WRITE_ENDPOINTS, 0))
+                self.assertEqual(len(fw.rules[project.id]), case['rules'])
+
+
+if __name__ == '__main__':
+    unittest.main()